@@ -3,16 +3,29 @@ import re
 import json
 import runpy
 import base64
+import io
 import sqlite3
 import hashlib
+import struct
+import zlib
 import time
-from typing import List, Dict, Tuple, Any, Union
+import unicodedata
+import uuid
+import contextvars
+from typing import List, Dict, Tuple, Any, Union, Callable
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+import queue
+import multiprocessing
+import httpx
 from dotenv import load_dotenv
 from PyPDF2 import PdfReader
 from crewai import Agent, Task, Crew, Process, LLM
+from crewai.llms.base_llm import BaseLLM
 from langchain_openai import AzureChatOpenAI
 import ssl
 import warnings
@@ -20,14 +33,22 @@ import shutil
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, validator
 import logging
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from tenacity import retry, stop_after_attempt, wait_fixed
 from copy import deepcopy
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Optional: token counts fall back to a chars/4 estimate
+    tiktoken = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -42,8 +63,23 @@ warnings.filterwarnings("ignore")
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_judge_llm()
+    job_workers = start_job_workers()
+    maintenance = asyncio.create_task(run_cache_maintenance_loop())
+    refresh_ahead = asyncio.create_task(run_refresh_ahead_loop())
+    yield
+    # Background tasks finish cancelling before the judge client they may use is closed
+    background = [maintenance, refresh_ahead, *report_refreshes.values()]
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await stop_job_workers(job_workers)
+    await close_judge_llm()
+
 # Initialize FastAPI app
-app = FastAPI(title="RRR Release Analysis Tool", description="API for analyzing release readiness reports")
+app = FastAPI(title="RRR Release Analysis Tool", description="API for analyzing release readiness reports", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -73,7 +109,87 @@ EXPECTED_METRICS = [
     "Automation Test Coverage", "Unit Test Coverage", "Defect Closure Rate",
     "Regression Issues", "Customer Specific Testing (UAT)"
 ]
+# Row labels that may appear in the metrics table besides EXPECTED_METRICS
+OTHER_TABLE_LABELS = ["Delivery Against Requirements"]
+STATUS_VALUES = ["ON TRACK", "MEDIUM RISK", "RISK", "NEEDS REVIEW"]
+# Status of table-parsed values the table gives no status for (its Status column is the current release's)
+UNKNOWN_STATUS = "UNKNOWN"
+UAT_CLIENTS = ['RBS', 'Tesco', 'Belk']
 CACHE_TTL_SECONDS = 3 * 24 * 60 * 60  # 3 days in seconds
+# Trends come from compute_trends; the LLM "Trend Analyst" stage is opt-in
+USE_LLM_TREND_ANALYST = os.getenv("USE_LLM_TREND_ANALYST", "false").lower() == "true"
+# Charts come from render_charts; the LLM-written visualizations.py is opt-in
+USE_LLM_VISUALIZER = os.getenv("USE_LLM_VISUALIZER", "false").lower() == "true"
+REPORT_SECTIONS = ["Overview", "Metrics Summary", "Key Findings", "Recommendations"]
+# Sections written by the LLM; the Metrics Summary is rendered from the metrics
+NARRATIVE_SECTIONS = ["Overview", "Key Findings", "Recommendations"]
+# Judge score a report must exceed to be accepted without another attempt
+REPORT_SCORE_THRESHOLD = 84
+# Report candidates generated and judged concurrently; 1 keeps the serial retry loop
+REPORT_CANDIDATES = max(1, int(os.getenv("REPORT_CANDIDATES", "1")))
+JUDGE_TIMEOUT_SECONDS = float(os.getenv("JUDGE_TIMEOUT_SECONDS", "120"))
+JUDGE_MAX_CONNECTIONS = int(os.getenv("JUDGE_MAX_CONNECTIONS", "8"))
+# Prompt budget: source text beyond this many tokens drops the oldest releases;
+# task prompts above PROMPT_TASK_TOKEN_CAP are logged as over budget
+PROMPT_SOURCE_TOKEN_CAP = int(os.getenv("PROMPT_SOURCE_TOKEN_CAP", "24000"))
+PROMPT_TASK_TOKEN_CAP = int(os.getenv("PROMPT_TASK_TOKEN_CAP", "32000"))
+# Cross-process single-flight: a running analysis holds a lease in cache.db,
+# renewed every third of the TTL; other workers poll for its cached report
+ANALYSIS_LEASE_TTL_SECONDS = int(os.getenv("ANALYSIS_LEASE_TTL_SECONDS", "60"))
+ANALYSIS_LEASE_POLL_SECONDS = float(os.getenv("ANALYSIS_LEASE_POLL_SECONDS", "2"))
+PIPELINE_STAGES = ["hash", "extract", "data", "report", "viz", "judge"]
+# Analysis jobs: JOB_WORKERS jobs run at once per process; a running job whose
+# heartbeat is older than JOB_STALE_SECONDS is requeued. Finished and failed
+# jobs are deleted by cache maintenance JOB_RETENTION_SECONDS after finishing.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "20"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 60 * 60)))  # 7 days
+SSE_KEEPALIVE_SECONDS = 15
+CHART_FIGSIZE = (8, 5)
+CHART_DPI = 120
+# Re-hash PDFs even when their (size, mtime, inode) fingerprint is unchanged
+FINGERPRINT_VERIFY = os.getenv("FINGERPRINT_VERIFY", "false").lower() == "true"
+# PDF extraction backend: "process" (default, sidesteps the GIL) or "thread"
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "process").lower()
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "0")) or os.cpu_count() or 4
+TEXT_CHUNK_CHARS = 16 * 1024  # Max characters normalized at once while streaming PDF text
+TABLE_MAX_CHARS = 256 * 1024  # Max characters held between the table headers before giving up
+# Persistent cache of LLM responses keyed by (deployment, temperature, prompt hash)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))  # 7 days
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 64 MB
+CACHE_DB_PATH = 'cache.db'
+CACHE_DB_POOL_SIZE = int(os.getenv("CACHE_DB_POOL_SIZE", "8"))
+# In-process tier in front of report_cache, sized by serialized report bytes
+REPORT_MEMORY_CACHE_BYTES = int(os.getenv("REPORT_MEMORY_CACHE_BYTES", str(128 * 1024 * 1024)))  # 128 MB
+# report_cache payload: magic, format version, header length, JSON header, zlib-compressed JSON body
+REPORT_PAYLOAD_MAGIC = b"RRC"
+REPORT_PAYLOAD_VERSION = 1
+REPORT_PAYLOAD_PREFIX = struct.Struct(">3sBI")
+# Background cache maintenance, started from the lifespan
+CACHE_MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("CACHE_MAINTENANCE_INTERVAL_SECONDS", "600"))
+CACHE_DELETE_BATCH = 500  # Rows deleted per write transaction
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 1 GB
+# PDF extraction results, fingerprints and table page hints older than
+# PDF_CACHE_TTL_SECONDS are recomputed on next use; beyond their caps the
+# oldest go first
+PDF_CACHE_TTL_SECONDS = int(os.getenv("PDF_CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60)))  # 30 days
+PDF_EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("PDF_EXTRACTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # 256 MB
+PDF_INDEX_MAX_ROWS = int(os.getenv("PDF_INDEX_MAX_ROWS", "100000"))
+# Expired reports are still served, flagged stale, for this long while a refresh runs
+CACHE_STALE_SECONDS = int(os.getenv("CACHE_STALE_SECONDS", str(7 * 24 * 60 * 60)))  # 7 days
+# Folders with REFRESH_AHEAD_MIN_HITS hits on their current report are
+# recomputed once it is within REFRESH_AHEAD_SECONDS of expiring
+REFRESH_AHEAD_SECONDS = int(os.getenv("REFRESH_AHEAD_SECONDS", str(6 * 60 * 60)))  # 6 hours
+REFRESH_AHEAD_MIN_HITS = int(os.getenv("REFRESH_AHEAD_MIN_HITS", "3"))
+REFRESH_AHEAD_INTERVAL_SECONDS = int(os.getenv("REFRESH_AHEAD_INTERVAL_SECONDS", "300"))
+REFRESH_MAX_CONCURRENT = int(os.getenv("REFRESH_MAX_CONCURRENT", "2"))
+# A folder whose background refresh failed is not refreshed again for
+# REFRESH_FAILURE_BACKOFF_SECONDS, doubling per consecutive failure up to the max
+REFRESH_FAILURE_BACKOFF_SECONDS = int(os.getenv("REFRESH_FAILURE_BACKOFF_SECONDS", str(15 * 60)))  # 15 minutes
+REFRESH_FAILURE_BACKOFF_MAX_SECONDS = int(os.getenv("REFRESH_FAILURE_BACKOFF_MAX_SECONDS", str(24 * 60 * 60)))  # 1 day
 
 # Pydantic models
 class FolderPathRequest(BaseModel):
@@ -92,6 +208,7 @@ class AnalysisResponse(BaseModel):
     report: str
     evaluation: Dict
     hyperlinks: List[Dict]
+    stale: bool = False  # Served from an expired cache entry while it is refreshed
 
 class MetricItem(BaseModel):
     version: str
@@ -99,21 +216,58 @@ class MetricItem(BaseModel):
     status: str
     trend: Union[str, None] = None
 
-# Shared state for thread-safe data sharing
+# Process-wide locks: viz_lock serializes pyplot-based visualization scripts
 class SharedState:
     def __init__(self):
-        self.metrics = None
-        self.report_parts = {}
-        self.lock = Lock()
-        self.visualization_ready = False
         self.viz_lock = Lock()
 
 shared_state = SharedState()
 
+class CacheDB:
+    # Pooled connections to cache.db. Reads check a connection out of the
+    # pool; writes also hold write_lock, which only serializes this process's
+    # cache.db writers. SQL is kept constant so every pooled connection reuses
+    # its prepared statements from sqlite3's statement cache.
+    def __init__(self, path: str = CACHE_DB_PATH, size: int = CACHE_DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.pool = queue.LifoQueue()
+        self.write_lock = Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if self.pool.qsize() < self.size:
+                self.pool.put_nowait(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def write(self):
+        with self.write_lock, self.connection() as conn:
+            yield conn
+            conn.commit()
+
+cache_db = CacheDB()
+
 # SQLite database setup
 def init_cache_db():
-    conn = sqlite3.connect('cache.db')
-    cursor = conn.cursor()
+    with cache_db.write() as conn:
+        create_cache_tables(conn.cursor())
+
+def create_cache_tables(cursor: sqlite3.Cursor):
     cursor.execute("PRAGMA journal_mode=WAL")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS report_cache (
@@ -123,89 +277,1085 @@ def init_cache_db():
             created_at INTEGER NOT NULL
         )
     ''')
-    conn.commit()
-    conn.close()
-
-init_cache_db()
+    # Rows written before the binary payload format keep their report_json
+    cursor.execute("PRAGMA table_info(report_cache)")
+    report_columns = {column[1] for column in cursor.fetchall()}
+    if "payload" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN payload BLOB")
+    # Report and chart bytes, and the last hit, for size-capped LRU eviction
+    if "size_bytes" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN size_bytes INTEGER")
+    if "last_used_at" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN last_used_at INTEGER")
+    # The folder and hits since the report was stored, for refresh-ahead
+    if "folder_path" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN folder_path TEXT")
+    if "hits" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN hits INTEGER NOT NULL DEFAULT 0")
+    # Consecutive failed background refreshes and when the next may run;
+    # storing a new report clears both
+    if "refresh_failures" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN refresh_failures INTEGER NOT NULL DEFAULT 0")
+    if "refresh_retry_at" not in report_columns:
+        cursor.execute("ALTER TABLE report_cache ADD COLUMN refresh_retry_at INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_cache_created ON report_cache (created_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_extraction_cache (
+            content_hash TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            table_text TEXT,
+            hyperlinks_json TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pdf_extraction_created ON pdf_extraction_cache (created_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_fingerprints (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            content_hash TEXT NOT NULL
+        )
+    ''')
+    # When the fingerprint was last hashed, for expiry; existing rows count from now
+    cursor.execute("PRAGMA table_info(pdf_fingerprints)")
+    if "updated_at" not in {column[1] for column in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE pdf_fingerprints ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("UPDATE pdf_fingerprints SET updated_at = ?", (int(time.time()),))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pdf_fingerprints_updated ON pdf_fingerprints (updated_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_table_pages (
+            path TEXT PRIMARY KEY,
+            start_page INTEGER NOT NULL,
+            end_page INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pdf_table_pages_updated ON pdf_table_pages (updated_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_leases (
+            folder_path_hash TEXT NOT NULL,
+            pdfs_hash TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            PRIMARY KEY (folder_path_hash, pdfs_hash)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            folder_path TEXT NOT NULL,
+            clear_cache INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            stages_json TEXT NOT NULL,
+            error TEXT,
+            result_json TEXT,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            heartbeat_at REAL,
+            finished_at REAL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)")
+    # Charts referenced by cached reports, stored once per image hash. They
+    # are kept base64-encoded, the form every response carries them in.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chart_blobs (
+            image_hash TEXT PRIMARY KEY,
+            image_base64 TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    # The charts each cached report references, written with the report so
+    # unreferenced charts can be found without reading payloads. A new table
+    # is filled from the existing payload headers.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'report_charts'")
+    backfill_report_charts = cursor.fetchone() is None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_charts (
+            folder_path_hash TEXT NOT NULL,
+            image_hash TEXT NOT NULL,
+            PRIMARY KEY (folder_path_hash, image_hash)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_charts_image ON report_charts (image_hash)")
+    if backfill_report_charts:
+        cursor.execute('SELECT folder_path_hash, payload, report_json FROM report_cache')
+        cursor.executemany('''
+            INSERT OR IGNORE INTO report_charts (folder_path_hash, image_hash) VALUES (?, ?)
+        ''', [(folder_path_hash, image_hash)
+              for folder_path_hash, payload, report_json in cursor.fetchall()
+              for image_hash in report_chart_hashes(payload, report_json)])
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            deployment TEXT NOT NULL,
+            temperature REAL,
+            response TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_used_at INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache (created_at)")
 
 def hash_string(s: str) -> str:
     return hashlib.md5(s.encode('utf-8')).hexdigest()
 
+def hash_file_contents(pdf_path: str) -> str:
+    hasher = hashlib.md5()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def fingerprint_pdf_files(pdf_files: List[str], verify: bool = FINGERPRINT_VERIFY) -> Dict[str, str]:
+    # Map each PDF to its content hash, reading file bytes only when the
+    # (size, mtime_ns, inode) stat tuple differs from the indexed one.
+    hashes = {}
+    updates = []
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        for pdf_path in pdf_files:
+            path = os.path.abspath(pdf_path)
+            st = os.stat(path)
+            cursor.execute('''
+                SELECT size, mtime_ns, inode, content_hash
+                FROM pdf_fingerprints
+                WHERE path = ?
+            ''', (path,))
+            row = cursor.fetchone()
+            stat_tuple = (st.st_size, st.st_mtime_ns, st.st_ino)
+            if row and tuple(row[:3]) == stat_tuple and not verify:
+                hashes[pdf_path] = row[3]
+                continue
+            content_hash = hash_file_contents(path)
+            if verify and row and tuple(row[:3]) == stat_tuple and row[3] != content_hash:
+                logger.warning(f"Fingerprint index out of date for {path}: contents changed without a stat change")
+            hashes[pdf_path] = content_hash
+            if not row or tuple(row) != (*stat_tuple, content_hash):
+                updates.append((path, *stat_tuple, content_hash, int(time.time())))
+
+    if updates:
+        with cache_db.write() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO pdf_fingerprints (path, size, mtime_ns, inode, content_hash, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', updates)
+        logger.info(f"Re-hashed {len(updates)} of {len(pdf_files)} PDF(s)")
+    return hashes
+
 def hash_pdf_contents(pdf_files: List[str]) -> str:
+    try:
+        hashes = fingerprint_pdf_files(pdf_files)
+    except Exception as e:
+        logger.error(f"Error hashing PDFs: {str(e)}")
+        raise
     hasher = hashlib.md5()
     for pdf_path in sorted(pdf_files):
-        try:
-            with open(pdf_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hasher.update(chunk)
-        except Exception as e:
-            logger.error(f"Error hashing PDF {pdf_path}: {str(e)}")
-            raise
+        hasher.update(hashes[pdf_path].encode('utf-8'))
     return hasher.hexdigest()
 
-def get_cached_report(folder_path_hash: str, pdfs_hash: str) -> Union[AnalysisResponse, None]:
+def get_cached_extraction(content_hash: str, source_file: str) -> Union[Dict[str, Any], None]:
+    try:
+        with cache_db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT table_text, hyperlinks_json
+                FROM pdf_extraction_cache
+                WHERE content_hash = ?
+            ''', (content_hash,))
+            result = cursor.fetchone()
+
+        if not result:
+            return None
+        table_text, hyperlinks_json = result
+        # Links are stored without their file name so that the same PDF copied
+        # into another release folder (or renamed) reuses the entry.
+        hyperlinks = [dict(link, source_file=source_file) for link in json.loads(hyperlinks_json)]
+        return {
+            "source_file": source_file,
+            "table_text": table_text,
+            "hyperlinks": hyperlinks
+        }
+    except Exception as e:
+        logger.error(f"Error retrieving cached extraction for {source_file}: {str(e)}")
+        return None
+
+def store_cached_extraction(content_hash: str, result: Dict[str, Any]):
+    try:
+        hyperlinks = [{k: v for k, v in link.items() if k != 'source_file'} for link in result["hyperlinks"]]
+        current_time = int(time.time())
+        # Only the table slice is kept; the text column is left empty
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO pdf_extraction_cache (content_hash, text, table_text, hyperlinks_json, created_at)
+                VALUES (?, '', ?, ?, ?)
+            ''', (content_hash, result["table_text"], json.dumps(hyperlinks), current_time))
+        logger.info(f"Cached extraction for {result['source_file']} ({content_hash})")
+    except Exception as e:
+        logger.error(f"Error storing cached extraction for {result['source_file']}: {str(e)}")
+
+def get_table_page_hint(pdf_path: str) -> Union[Tuple[int, int], None]:
+    try:
+        with cache_db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT start_page, end_page
+                FROM pdf_table_pages
+                WHERE path = ?
+            ''', (os.path.abspath(pdf_path),))
+            result = cursor.fetchone()
+        return tuple(result) if result else None
+    except Exception as e:
+        logger.error(f"Error retrieving table page range for {pdf_path}: {str(e)}")
+        return None
+
+def store_table_page_hint(pdf_path: str, start_page: int, end_page: int):
     try:
-        conn = sqlite3.connect('cache.db')
+        current_time = int(time.time())
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO pdf_table_pages (path, start_page, end_page, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', (os.path.abspath(pdf_path), start_page, end_page, current_time))
+    except Exception as e:
+        logger.error(f"Error storing table page range for {pdf_path}: {str(e)}")
+
+class ReportMemoryCache:
+    # In-process LRU of decoded AnalysisResponse objects in front of
+    # report_cache, evicted by the size of their serialized JSON. Like the
+    # table it holds one report per folder. Entries are shared between
+    # callers and are not mutated.
+    def __init__(self, max_bytes: int = REPORT_MEMORY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # folder_path_hash -> (pdfs_hash, response, created_at, size_bytes)
+        self.size_bytes = 0
+        self.lock = Lock()
+
+    def get(self, folder_path_hash: str, pdfs_hash: str, min_created_at: int = 0) -> Union[Tuple[AnalysisResponse, int], None]:
+        # Returns (response, created_at); entries past their TTL are kept
+        # through the stale period
+        with self.lock:
+            entry = self.entries.get(folder_path_hash)
+            if entry is None or entry[0] != pdfs_hash or entry[2] < min_created_at:
+                return None
+            if int(time.time()) - entry[2] >= CACHE_TTL_SECONDS + CACHE_STALE_SECONDS:
+                self.discard(folder_path_hash)
+                return None
+            self.entries.move_to_end(folder_path_hash)
+            return entry[1], entry[2]
+
+    def put(self, folder_path_hash: str, pdfs_hash: str, response: AnalysisResponse, created_at: int, size_bytes: int):
+        with self.lock:
+            self.discard(folder_path_hash)
+            if size_bytes > self.max_bytes:
+                return
+            self.entries[folder_path_hash] = (pdfs_hash, response, created_at, size_bytes)
+            self.size_bytes += size_bytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= evicted[3]
+
+    def discard(self, folder_path_hash: str):
+        # Callers hold self.lock
+        entry = self.entries.pop(folder_path_hash, None)
+        if entry:
+            self.size_bytes -= entry[3]
+
+    def remove(self, folder_path_hashes: List[str]):
+        with self.lock:
+            for folder_path_hash in folder_path_hashes:
+                self.discard(folder_path_hash)
+
+    def expire(self, cutoff: int):
+        with self.lock:
+            for folder_path_hash in [key for key, entry in self.entries.items() if entry[2] < cutoff]:
+                self.discard(folder_path_hash)
+
+report_memory_cache = ReportMemoryCache()
+
+def store_chart_blobs(conn: sqlite3.Connection, visualizations: List[str]) -> List[str]:
+    # Stores each chart once and returns the hashes referencing them, in order
+    image_hashes = [hashlib.sha256(image.encode('ascii')).hexdigest() for image in visualizations]
+    current_time = int(time.time())
+    conn.executemany('''
+        INSERT OR IGNORE INTO chart_blobs (image_hash, image_base64, created_at)
+        VALUES (?, ?, ?)
+    ''', [(image_hash, image, current_time) for image_hash, image in zip(image_hashes, visualizations)])
+    return image_hashes
+
+def load_chart_blobs(image_hashes: List[str]) -> List[str]:
+    if not image_hashes:
+        return []
+    with cache_db.connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT report_json, created_at
-            FROM report_cache
-            WHERE folder_path_hash = ? AND pdfs_hash = ?
-        ''', (folder_path_hash, pdfs_hash))
-        result = cursor.fetchone()
-        conn.close()
+            SELECT image_hash, image_base64
+            FROM chart_blobs
+            WHERE image_hash IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(image_hashes),))
+        blobs = dict(cursor.fetchall())
+    missing = [image_hash for image_hash in image_hashes if image_hash not in blobs]
+    if missing:
+        raise KeyError(f"Missing {len(missing)} chart blob(s)")
+    return [blobs[image_hash] for image_hash in image_hashes]
+
+def metrics_versions(metrics: Dict[str, Any]) -> List[str]:
+    versions = set()
+    for data in metrics.get('metrics', {}).values():
+        for items in (data.values() if isinstance(data, dict) else [data]):
+            versions.update(item['version'] for item in items if isinstance(item, dict) and 'version' in item)
+    return sorted(versions, key=release_sort_key)
+
+def encode_report_payload(report_dict: Dict[str, Any], header: Dict[str, Any]) -> bytes:
+    body = json.dumps(report_dict, separators=(',', ':')).encode('utf-8')
+    header = json.dumps(dict(header, body_bytes=len(body)), separators=(',', ':')).encode('utf-8')
+    prefix = REPORT_PAYLOAD_PREFIX.pack(REPORT_PAYLOAD_MAGIC, REPORT_PAYLOAD_VERSION, len(header))
+    return prefix + header + zlib.compress(body)
+
+def read_report_payload_header(payload: bytes) -> Tuple[Dict[str, Any], int]:
+    # Returns the header and the offset of the compressed body, without inflating it
+    magic, version, header_length = REPORT_PAYLOAD_PREFIX.unpack_from(payload)
+    if magic != REPORT_PAYLOAD_MAGIC or version != REPORT_PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported report payload format: {magic!r} v{version}")
+    body_offset = REPORT_PAYLOAD_PREFIX.size + header_length
+    return json.loads(payload[REPORT_PAYLOAD_PREFIX.size:body_offset]), body_offset
+
+def decode_report_payload(payload: bytes) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    header, body_offset = read_report_payload_header(payload)
+    return header, json.loads(zlib.decompress(payload[body_offset:]))
+
+def report_chart_hashes(payload: Union[bytes, None], report_json: str) -> List[str]:
+    # Chart hashes of a report_cache row, read from its payload header
+    if payload is not None:
+        return read_report_payload_header(payload)[0]["chart_hashes"]
+    return (json.loads(report_json).get("chart_hashes") or []) if report_json else []
+
+init_cache_db()
+
+def cached_report_state(created_at: int) -> str:
+    age = int(time.time()) - created_at
+    if age < CACHE_TTL_SECONDS:
+        return "fresh"
+    return "stale" if age < CACHE_TTL_SECONDS + CACHE_STALE_SECONDS else "expired"
+
+def get_cached_report(folder_path_hash: str, pdfs_hash: str, min_created_at: int = 0,
+                      with_charts: bool = True, allow_stale: bool = False) -> Union[AnalysisResponse, None]:
+    # The payload holds the report with chart hashes in place of the images.
+    # Charts are only read from chart_blobs when with_charts is set; without
+    # them the response comes back with no visualizations. Cached reports
+    # were validated when stored, so they are not validated again. With
+    # allow_stale, a report past its TTL is returned flagged stale.
+    try:
+        cached = report_memory_cache.get(folder_path_hash, pdfs_hash, min_created_at)
+        if cached is not None:
+            response, created_at = cached
+            # Another worker process may have replaced or deleted the row, so
+            # a memory hit is only used while the row it was decoded from is
+            # still the current one
+            with cache_db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT pdfs_hash, created_at FROM report_cache WHERE folder_path_hash = ?
+                ''', (folder_path_hash,))
+                current = cursor.fetchone()
+            if current == (pdfs_hash, created_at):
+                state = cached_report_state(created_at)
+                if state == "fresh" or (state == "stale" and allow_stale):
+                    touch_cached_report(folder_path_hash)
+                    return response if state == "fresh" else response.copy(update={"stale": True})
+                return None
+            report_memory_cache.remove([folder_path_hash])
+
+        with cache_db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT payload, report_json, created_at
+                FROM report_cache
+                WHERE folder_path_hash = ? AND pdfs_hash = ? AND created_at >= ?
+            ''', (folder_path_hash, pdfs_hash, min_created_at))
+            result = cursor.fetchone()
 
         if result:
-            report_json, created_at = result
-            current_time = int(time.time())
-            if current_time - created_at < CACHE_TTL_SECONDS:
-                report_dict = json.loads(report_json)
-                return AnalysisResponse(**report_dict)
-            else:
-                with shared_state.lock:
-                    conn = sqlite3.connect('cache.db')
-                    cursor = conn.cursor()
-                    cursor.execute('DELETE FROM report_cache WHERE folder_path_hash = ?', (folder_path_hash,))
-                    conn.commit()
-                    conn.close()
+            payload, report_json, created_at = result
+            state = cached_report_state(created_at)
+            if state == "fresh" or (state == "stale" and allow_stale):
+                if payload is not None:
+                    header, report_dict = decode_report_payload(payload)
+                    chart_hashes = header["chart_hashes"]
+                    size_bytes = header["body_bytes"]
+                else:
+                    # Entry written before the payload format
+                    report_dict = json.loads(report_json)
+                    chart_hashes = report_dict.pop("chart_hashes", None)
+                    size_bytes = len(report_json)
+                if chart_hashes is None:
+                    # Entry written before charts moved to chart_blobs
+                    response = AnalysisResponse.construct(**report_dict)
+                elif not with_charts:
+                    return AnalysisResponse.construct(**report_dict, visualizations=[], stale=state == "stale")
+                else:
+                    response = AnalysisResponse.construct(**report_dict, visualizations=load_chart_blobs(chart_hashes))
+                size_bytes += sum(len(image) for image in response.visualizations)
+                report_memory_cache.put(folder_path_hash, pdfs_hash, response, created_at, size_bytes)
+                touch_cached_report(folder_path_hash)
+                return response if state == "fresh" else response.copy(update={"stale": True})
+            # Expired rows are left to the background maintenance task
         return None
     except Exception as e:
         logger.error(f"Error retrieving cached report: {str(e)}")
         return None
 
-def store_cached_report(folder_path_hash: str, pdfs_hash: str, response: AnalysisResponse):
+def store_cached_report(folder_path_hash: str, pdfs_hash: str, response: AnalysisResponse,
+                        folder_path: Union[str, None] = None):
+    # folder_path lets refresh-ahead recompute the report; hits start over
     try:
-        report_json = json.dumps(response.dict())
+        report_dict = response.dict(exclude={"visualizations", "stale"})
         current_time = int(time.time())
-        with shared_state.lock:
-            conn = sqlite3.connect('cache.db')
+        with cache_db.write() as conn:
+            header = {
+                "chart_hashes": store_chart_blobs(conn, response.visualizations),
+                "score": response.evaluation.get("score"),
+                "versions": metrics_versions(response.metrics),
+            }
+            payload = encode_report_payload(report_dict, header)
+            chart_bytes = sum(len(image) for image in response.visualizations)
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT OR REPLACE INTO report_cache (folder_path_hash, pdfs_hash, report_json, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (folder_path_hash, pdfs_hash, report_json, current_time))
-            conn.commit()
-            conn.close()
-        logger.info(f"Cached report for folder_path_hash: {folder_path_hash}")
+                INSERT OR REPLACE INTO report_cache
+                (folder_path_hash, pdfs_hash, report_json, created_at, payload, size_bytes, last_used_at, folder_path, hits)
+                VALUES (?, ?, '', ?, ?, ?, ?, ?, 0)
+            ''', (folder_path_hash, pdfs_hash, current_time, payload, len(payload) + chart_bytes, current_time, folder_path))
+            # Same transaction as the charts, so a stored chart is never
+            # without its reference
+            cursor.execute('DELETE FROM report_charts WHERE folder_path_hash = ?', (folder_path_hash,))
+            cursor.executemany('''
+                INSERT OR IGNORE INTO report_charts (folder_path_hash, image_hash) VALUES (?, ?)
+            ''', [(folder_path_hash, image_hash) for image_hash in header["chart_hashes"]])
+        size_bytes = read_report_payload_header(payload)[0]["body_bytes"] + chart_bytes
+        report_memory_cache.put(folder_path_hash, pdfs_hash, response, current_time, size_bytes)
+        logger.info(f"Cached report for folder_path_hash: {folder_path_hash} ({len(payload)} byte payload)")
     except Exception as e:
         logger.error(f"Error storing cached report: {str(e)}")
 
-def cleanup_old_cache():
+def list_cached_reports(limit: int = 100) -> List[Dict[str, Any]]:
+    # Most recently used cached reports, described from payload headers
+    # alone; no report body is inflated
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT folder_path_hash, folder_path, payload, created_at, last_used_at, hits, size_bytes
+            FROM report_cache
+            WHERE payload IS NOT NULL
+            ORDER BY last_used_at DESC
+            LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+    reports = []
+    for folder_path_hash, folder_path, payload, created_at, last_used_at, hits, size_bytes in rows:
+        header = read_report_payload_header(payload)[0]
+        reports.append({
+            "folder_path_hash": folder_path_hash,
+            "folder_path": folder_path,
+            "state": cached_report_state(created_at),
+            "score": header["score"],
+            "versions": header["versions"],
+            "charts": len(header["chart_hashes"]),
+            "created_at": created_at,
+            "last_used_at": last_used_at,
+            "hits": hits,
+            "size_bytes": size_bytes,
+        })
+    return reports
+
+def delete_in_batches(delete_sql: str, params: Tuple = ()) -> int:
+    # delete_sql takes params followed by a row limit. Each batch commits on
+    # its own so cache readers and writers are never held up for long.
+    deleted = 0
+    while True:
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute(delete_sql, (*params, CACHE_DELETE_BATCH))
+            batch = cursor.rowcount
+        deleted += batch
+        if batch < CACHE_DELETE_BATCH:
+            return deleted
+
+def lru_eviction_keys(select_sql: str, max_bytes: int) -> List[str]:
+    # select_sql returns the keys whose running size, newest use first, exceeds max_bytes
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(select_sql, (max_bytes,))
+        return [row[0] for row in cursor.fetchall()]
+
+def delete_keys_in_batches(delete_sql: str, keys: List[str]) -> int:
+    # delete_sql takes a JSON array of keys
+    deleted = 0
+    for i in range(0, len(keys), CACHE_DELETE_BATCH):
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute(delete_sql, (json.dumps(keys[i:i + CACHE_DELETE_BATCH]),))
+            deleted += cursor.rowcount
+    return deleted
+
+report_cache_touches = {}
+report_cache_touches_lock = Lock()
+
+def touch_cached_report(folder_path_hash: str):
+    # Hits are recorded in memory and written to last_used_at and hits by the
+    # maintenance and refresh-ahead tasks
+    with report_cache_touches_lock:
+        _, hits = report_cache_touches.get(folder_path_hash, (0, 0))
+        report_cache_touches[folder_path_hash] = (int(time.time()), hits + 1)
+
+def flush_report_cache_touches() -> int:
+    with report_cache_touches_lock:
+        touches = list(report_cache_touches.items())
+        report_cache_touches.clear()
+    if touches:
+        with cache_db.write() as conn:
+            conn.executemany('''
+                UPDATE report_cache
+                SET last_used_at = MAX(COALESCE(last_used_at, 0), ?), hits = hits + ?
+                WHERE folder_path_hash = ?
+            ''', [(used_at, hits, folder_path_hash) for folder_path_hash, (used_at, hits) in touches])
+    return len(touches)
+
+def cleanup_old_cache() -> int:
+    # Reports are kept through the stale period after their TTL
+    cutoff = int(time.time()) - CACHE_TTL_SECONDS - CACHE_STALE_SECONDS
+    report_memory_cache.expire(cutoff)
+    return delete_in_batches('''
+        DELETE FROM report_cache
+        WHERE rowid IN (SELECT rowid FROM report_cache WHERE created_at < ? LIMIT ?)
+    ''', (cutoff,))
+
+def evict_report_cache() -> int:
+    # Least recently used reports beyond REPORT_CACHE_MAX_BYTES
+    keys = lru_eviction_keys('''
+        SELECT folder_path_hash FROM (
+            SELECT folder_path_hash,
+                   SUM(COALESCE(size_bytes, LENGTH(report_json))) OVER (
+                       ORDER BY COALESCE(last_used_at, created_at) DESC, created_at DESC
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                   ) AS running_bytes
+            FROM report_cache
+        )
+        WHERE running_bytes > ?
+    ''', REPORT_CACHE_MAX_BYTES)
+    report_memory_cache.remove(keys)
+    return delete_keys_in_batches('''
+        DELETE FROM report_cache
+        WHERE folder_path_hash IN (SELECT value FROM json_each(?))
+    ''', keys)
+
+def collect_chart_blobs() -> int:
+    # References left by deleted reports, then charts no longer referenced
+    # by any cached report. A report's charts and references are stored in
+    # one transaction, so each batch sees either both or neither.
+    delete_in_batches('''
+        DELETE FROM report_charts
+        WHERE rowid IN (
+            SELECT rowid FROM report_charts c
+            WHERE NOT EXISTS (SELECT 1 FROM report_cache r WHERE r.folder_path_hash = c.folder_path_hash)
+            LIMIT ?
+        )
+    ''')
+    return delete_in_batches('''
+        DELETE FROM chart_blobs
+        WHERE rowid IN (
+            SELECT rowid FROM chart_blobs b
+            WHERE NOT EXISTS (SELECT 1 FROM report_charts c WHERE c.image_hash = b.image_hash)
+            LIMIT ?
+        )
+    ''')
+
+def cleanup_pdf_caches() -> int:
+    # Expired rows, then the oldest beyond each table's cap. A deleted
+    # fingerprint costs one re-hash, a deleted page hint one full scan.
+    cutoff = int(time.time()) - PDF_CACHE_TTL_SECONDS
+    deleted = 0
+    for table, column in [("pdf_extraction_cache", "created_at"), ("pdf_fingerprints", "updated_at"),
+                          ("pdf_table_pages", "updated_at")]:
+        deleted += delete_in_batches(f'''
+            DELETE FROM {table}
+            WHERE rowid IN (SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)
+        ''', (cutoff,))
+    for table in ["pdf_fingerprints", "pdf_table_pages"]:
+        deleted += delete_in_batches(f'''
+            DELETE FROM {table}
+            WHERE rowid IN (
+                SELECT rowid FROM (SELECT rowid FROM {table} ORDER BY updated_at DESC LIMIT -1 OFFSET ?)
+                LIMIT ?
+            )
+        ''', (PDF_INDEX_MAX_ROWS,))
+    keys = lru_eviction_keys('''
+        SELECT content_hash FROM (
+            SELECT content_hash,
+                   SUM(COALESCE(LENGTH(table_text), 0) + LENGTH(hyperlinks_json)) OVER (
+                       ORDER BY created_at DESC
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                   ) AS running_bytes
+            FROM pdf_extraction_cache
+        )
+        WHERE running_bytes > ?
+    ''', PDF_EXTRACTION_CACHE_MAX_BYTES)
+    return deleted + delete_keys_in_batches('''
+        DELETE FROM pdf_extraction_cache
+        WHERE content_hash IN (SELECT value FROM json_each(?))
+    ''', keys)
+
+def cleanup_llm_cache() -> int:
+    expired = delete_in_batches('''
+        DELETE FROM llm_cache
+        WHERE rowid IN (SELECT rowid FROM llm_cache WHERE created_at < ? LIMIT ?)
+    ''', (int(time.time()) - LLM_CACHE_TTL_SECONDS,))
+    # Evict least recently used entries once the cache exceeds its size budget
+    keys = lru_eviction_keys('''
+        SELECT cache_key FROM (
+            SELECT cache_key,
+                   SUM(size_bytes) OVER (
+                       ORDER BY last_used_at DESC, created_at DESC
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                   ) AS running_bytes
+            FROM llm_cache
+        )
+        WHERE running_bytes > ?
+    ''', LLM_CACHE_MAX_BYTES)
+    return expired + delete_keys_in_batches('''
+        DELETE FROM llm_cache
+        WHERE cache_key IN (SELECT value FROM json_each(?))
+    ''', keys)
+
+def cleanup_finished_jobs() -> int:
+    return delete_in_batches('''
+        DELETE FROM jobs
+        WHERE rowid IN (
+            SELECT rowid FROM jobs
+            WHERE status IN ('done', 'failed') AND finished_at < ?
+            LIMIT ?
+        )
+    ''', (time.time() - JOB_RETENTION_SECONDS,))
+
+def checkpoint_cache_db() -> Tuple[int, int, int]:
+    # PASSIVE never waits on readers or writers; returns (busy, WAL frames, checkpointed frames)
+    with cache_db.connection() as conn:
+        return tuple(conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone())
+
+def run_cache_maintenance():
+    started = time.time()
+    touched = flush_report_cache_touches()
+    expired = cleanup_old_cache()
+    evicted = evict_report_cache()
+    charts = collect_chart_blobs()
+    llm_entries = cleanup_llm_cache()
+    pdf_entries = cleanup_pdf_caches()
+    jobs = cleanup_finished_jobs()
+    busy, wal_frames, checkpointed = checkpoint_cache_db()
+    logger.info(
+        f"Cache maintenance in {time.time() - started:.2f}s: {touched} report hit(s) recorded, "
+        f"{expired} expired and {evicted} evicted report(s), {charts} chart(s), {llm_entries} LLM "
+        f"entries, {pdf_entries} PDF cache entries and {jobs} finished job(s) deleted, "
+        f"WAL checkpoint {checkpointed}/{wal_frames} frames{' (busy)' if busy else ''}"
+    )
+
+async def run_cache_maintenance_loop():
+    while True:
+        try:
+            await asyncio.to_thread(run_cache_maintenance)
+        except Exception as e:
+            logger.error(f"Cache maintenance failed: {str(e)}")
+        await asyncio.sleep(CACHE_MAINTENANCE_INTERVAL_SECONDS)
+
+# Retry attempts set a variant so that a rejected report is not replayed from the cache
+llm_cache_variant = contextvars.ContextVar("llm_cache_variant", default="")
+# clear_cache analyses skip cache reads, so a forced re-run or background
+# refresh gets new responses; those responses are still stored
+llm_cache_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+llm_cache_counters = {"hits": 0, "misses": 0}
+llm_cache_counters_lock = Lock()
+
+def llm_cache_key(deployment: str, temperature: Union[float, None], prompt: Any, tools: Union[List, None] = None) -> str:
+    payload = json.dumps({
+        "deployment": deployment,
+        "temperature": temperature,
+        "prompt": prompt,
+        "tools": sorted(str(tool.get("function", {}).get("name", tool) if isinstance(tool, dict) else tool) for tool in tools or []),
+        "variant": llm_cache_variant.get(),
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def count_llm_cache(hit: bool):
+    with llm_cache_counters_lock:
+        llm_cache_counters["hits" if hit else "misses"] += 1
+
+def get_cached_llm_response(cache_key: str) -> Union[str, None]:
     try:
         current_time = int(time.time())
-        with shared_state.lock:
-            conn = sqlite3.connect('cache.db')
+        with cache_db.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                DELETE FROM report_cache
-                WHERE created_at < ?
-            ''', (current_time - CACHE_TTL_SECONDS,))
-            deleted_rows = cursor.rowcount
-            conn.commit()
-            conn.close()
-        logger.info(f"Cleaned up old cache entries, deleted {deleted_rows} rows")
+                SELECT response, created_at
+                FROM llm_cache
+                WHERE cache_key = ?
+            ''', (cache_key,))
+            result = cursor.fetchone()
+
+        if not result or current_time - result[1] > LLM_CACHE_TTL_SECONDS:
+            return None
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE llm_cache
+                SET last_used_at = ?, hits = hits + 1
+                WHERE cache_key = ?
+            ''', (current_time, cache_key))
+        return result[0]
+    except Exception as e:
+        logger.error(f"Error retrieving cached LLM response: {str(e)}")
+        return None
+
+def store_cached_llm_response(cache_key: str, deployment: str, temperature: Union[float, None], response: str):
+    try:
+        current_time = int(time.time())
+        size_bytes = len(response.encode('utf-8'))
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO llm_cache
+                (cache_key, deployment, temperature, response, size_bytes, created_at, last_used_at, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (cache_key, deployment, temperature, response, size_bytes, current_time, current_time))
+    except Exception as e:
+        logger.error(f"Error storing cached LLM response: {str(e)}")
+
+def lookup_llm_cache(deployment: str, temperature: Union[float, None], prompt: Any, tools: Union[List, None] = None) -> Tuple[str, Union[str, None]]:
+    cache_key = llm_cache_key(deployment, temperature, prompt, tools)
+    if llm_cache_bypass.get():
+        return cache_key, None
+    cached = get_cached_llm_response(cache_key)
+    count_llm_cache(cached is not None)
+    if cached is not None:
+        logger.info(f"LLM cache hit for {deployment} ({cache_key[:12]})")
+    return cache_key, cached
+
+def cached_llm_call(deployment: str, temperature: Union[float, None], prompt: Any, call, tools: Union[List, None] = None) -> str:
+    if not LLM_CACHE_ENABLED:
+        return call()
+    cache_key, cached = lookup_llm_cache(deployment, temperature, prompt, tools)
+    if cached is not None:
+        return cached
+    response = call()
+    if isinstance(response, str) and response.strip():
+        store_cached_llm_response(cache_key, deployment, temperature, response)
+    return response
+
+async def cached_llm_acall(deployment: str, temperature: Union[float, None], prompt: Any, acall,
+                           usable: Union[Callable[[str], bool], None] = None) -> str:
+    # usable, when given, decides whether a response may be cached; a cached
+    # response it rejects is treated as a miss and overwritten.
+    if not LLM_CACHE_ENABLED:
+        return await acall()
+    # The sqlite lookup and store run off the event loop
+    cache_key, cached = await asyncio.to_thread(lookup_llm_cache, deployment, temperature, prompt)
+    if cached is not None and (usable is None or usable(cached)):
+        return cached
+    response = await acall()
+    if isinstance(response, str) and response.strip() and (usable is None or usable(response)):
+        await asyncio.to_thread(store_cached_llm_response, cache_key, deployment, temperature, response)
+    return response
+
+def get_llm_cache_stats() -> Dict[str, Any]:
+    with llm_cache_counters_lock:
+        hits, misses = llm_cache_counters["hits"], llm_cache_counters["misses"]
+    stats = {
+        "enabled": LLM_CACHE_ENABLED,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        "entries": 0,
+        "size_bytes": 0,
+        "max_bytes": LLM_CACHE_MAX_BYTES,
+        "ttl_seconds": LLM_CACHE_TTL_SECONDS,
+    }
+    try:
+        with cache_db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*), COALESCE(SUM(size_bytes), 0)
+                FROM llm_cache
+            ''')
+            stats["entries"], stats["size_bytes"] = cursor.fetchone()
+    except Exception as e:
+        logger.error(f"Error reading LLM cache stats: {str(e)}")
+    return stats
+
+class CachedLLM(BaseLLM):
+    # Wraps a crewai LLM so that every agent call goes through the llm_cache table.
+    _inner: Any = None
+
+    def __init__(self, inner: BaseLLM):
+        super().__init__(model=inner.model, temperature=inner.temperature)
+        self._inner = inner
+
+    def call(self, messages, tools=None, callbacks=None, available_functions=None, **kwargs):
+        def invoke():
+            # crewai sets stop words on the LLM handed to the agent, so pass them on
+            if self.stop:
+                self._inner.stop = self.stop
+            return self._inner.call(messages, tools=tools, callbacks=callbacks,
+                                    available_functions=available_functions, **kwargs)
+        # Tool-executing calls have side effects, so they always go to the model
+        if available_functions:
+            return invoke()
+        return cached_llm_call(self.model, self.temperature, messages, invoke, tools)
+
+    def supports_function_calling(self) -> bool:
+        supports = getattr(self._inner, "supports_function_calling", None)
+        return bool(callable(supports) and supports())
+
+    def supports_stop_words(self) -> bool:
+        return self._inner.supports_stop_words()
+
+    def get_context_window_size(self) -> int:
+        return self._inner.get_context_window_size()
+
+if LLM_CACHE_ENABLED:
+    llm = CachedLLM(llm)
+
+@lru_cache(maxsize=1)
+def get_token_encoder():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken encoding unavailable, estimating tokens: {str(e)}")
+        return None
+
+def count_tokens(text: str) -> int:
+    encoder = get_token_encoder()
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+class PromptBudget:
+    # Token counts per prompt, split into the template and the data embedded in it
+    def __init__(self):
+        self.prompts = {}
+        self.lock = Lock()
+
+    def record(self, name: str, **parts: str):
+        breakdown = {part: count_tokens(text) for part, text in parts.items()}
+        breakdown["total"] = sum(breakdown.values())
+        if breakdown["total"] > PROMPT_TASK_TOKEN_CAP:
+            logger.warning(f"Prompt {name} is {breakdown['total']} tokens, over the {PROMPT_TASK_TOKEN_CAP} token cap")
+        with self.lock:
+            calls = self.prompts.get(name, {}).get("calls", 0)
+            self.prompts[name] = {**breakdown, "calls": calls + 1}
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            prompts = deepcopy(self.prompts)
+        return {
+            "prompts": prompts,
+            "total_tokens": sum(p["total"] * p["calls"] for p in prompts.values()),
+            "counter": "tiktoken" if get_token_encoder() else "chars/4",
+        }
+
+# Prompt budget of the latest analysis of each folder, by folder_path_hash
+prompt_budgets = OrderedDict()
+prompt_budgets_lock = Lock()
+PROMPT_BUDGET_HISTORY = 64
+
+class StageProgress:
+    # Stage-level progress of one analysis. Every caller sharing the analysis
+    # subscribes a listener(stage, state) and optionally an
+    # event_listener(event, data) for partial results (metrics, charts, report
+    # sections, evaluation); late subscribers get both replayed. Stages and
+    # events may be published from worker threads.
+    def __init__(self):
+        self.stages = {stage: "pending" for stage in PIPELINE_STAGES}
+        self.events = []
+        self.listeners = []
+        self.event_listeners = []
+        self.lock = Lock()
+
+    def subscribe(self, listener=None, event_listener=None):
+        with self.lock:
+            if listener:
+                self.listeners.append(listener)
+            if event_listener:
+                self.event_listeners.append(event_listener)
+            reached = [(stage, state) for stage, state in self.stages.items() if state != "pending"]
+            events = list(self.events)
+        if listener:
+            for stage, state in reached:
+                listener(stage, state)
+        if event_listener:
+            for event, data in events:
+                event_listener(event, data)
+
+    def unsubscribe(self, listener=None, event_listener=None):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+            if event_listener in self.event_listeners:
+                self.event_listeners.remove(event_listener)
+
+    def update(self, stage: str, state: str):
+        with self.lock:
+            self.stages[stage] = state
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(stage, state)
+            except Exception as e:
+                logger.error(f"Progress listener failed for stage {stage}: {str(e)}")
+
+    def publish(self, event: str, data: Any):
+        with self.lock:
+            self.events.append((event, data))
+            listeners = list(self.event_listeners)
+        for listener in listeners:
+            try:
+                listener(event, data)
+            except Exception as e:
+                logger.error(f"Event listener failed for event {event}: {str(e)}")
+
+class PipelineContext:
+    # State of one analysis, shared by its stages and crew task callbacks, so
+    # that concurrent analyses in one process don't overwrite each other.
+    def __init__(self, folder_path: str, progress: Union[StageProgress, None] = None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.folder_path = folder_path
+        self.metrics = None
+        self.output_dir = os.path.join("visualizations", self.run_id)
+        self.script_path = os.path.join(self.output_dir, "visualizations.py")
+        self.budget = PromptBudget()
+        self.progress = progress or StageProgress()
+        self.lock = Lock()
+
+    def set_metrics(self, metrics: Union[Dict[str, Any], None]):
+        with self.lock:
+            self.metrics = metrics
+
+    def cleanup(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+def acquire_analysis_lease(folder_path_hash: str, pdfs_hash: str, owner: str) -> bool:
+    # Claims the (folder, PDFs) analysis for this worker unless another live
+    # worker process holds it. Expired leases are taken over.
+    try:
+        current_time = int(time.time())
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO analysis_leases (folder_path_hash, pdfs_hash, owner, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (folder_path_hash, pdfs_hash) DO UPDATE
+                SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE analysis_leases.expires_at < ?
+            ''', (folder_path_hash, pdfs_hash, owner, current_time + ANALYSIS_LEASE_TTL_SECONDS, current_time))
+            acquired = cursor.rowcount == 1
+        return acquired
+    except Exception as e:
+        # Without the lease table, run the analysis rather than wait on it
+        logger.error(f"Error acquiring analysis lease: {str(e)}")
+        return True
+
+def renew_analysis_lease(folder_path_hash: str, pdfs_hash: str, owner: str):
+    try:
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE analysis_leases
+                SET expires_at = ?
+                WHERE folder_path_hash = ? AND pdfs_hash = ? AND owner = ?
+            ''', (int(time.time()) + ANALYSIS_LEASE_TTL_SECONDS, folder_path_hash, pdfs_hash, owner))
+    except Exception as e:
+        logger.error(f"Error renewing analysis lease: {str(e)}")
+
+def release_analysis_lease(folder_path_hash: str, pdfs_hash: str, owner: str):
+    try:
+        with cache_db.write() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM analysis_leases
+                WHERE folder_path_hash = ? AND pdfs_hash = ? AND owner = ?
+            ''', (folder_path_hash, pdfs_hash, owner))
     except Exception as e:
-        logger.error(f"Error cleaning up old cache entries: {str(e)}")
+        logger.error(f"Error releasing analysis lease: {str(e)}")
+
+def enqueue_job(folder_path: str, clear_cache: bool) -> Tuple[str, str]:
+    # Returns (job_id, status). A folder that already has a queued or running
+    # job gets that job back instead of a duplicate.
+    with cache_db.write() as conn:
+        cursor = conn.cursor()
+        if not clear_cache:
+            cursor.execute('''
+                SELECT job_id, status
+                FROM jobs
+                WHERE folder_path = ? AND clear_cache = 0 AND status IN ('queued', 'running')
+                ORDER BY created_at
+                LIMIT 1
+            ''', (folder_path,))
+            existing = cursor.fetchone()
+            if existing:
+                return existing[0], existing[1]
+        job_id = uuid.uuid4().hex
+        cursor.execute('''
+            INSERT INTO jobs (job_id, folder_path, clear_cache, status, stages_json, created_at)
+            VALUES (?, ?, ?, 'queued', ?, ?)
+        ''', (job_id, folder_path, int(clear_cache), json.dumps({stage: "pending" for stage in PIPELINE_STAGES}), time.time()))
+    return job_id, "queued"
+
+def claim_next_job(worker: str) -> Union[Tuple[str, str, bool], None]:
+    # Oldest queued job first; running jobs whose worker stopped heartbeating
+    # are picked up again. A single UPDATE keeps claims atomic across processes.
+    current_time = time.time()
+    with cache_db.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE jobs
+            SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?
+            WHERE job_id = (
+                SELECT job_id FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?)
+                ORDER BY created_at
+                LIMIT 1
+            )
+            RETURNING job_id, folder_path, clear_cache
+        ''', (worker, current_time, current_time, current_time - JOB_STALE_SECONDS))
+        row = cursor.fetchone()
+    return (row[0], row[1], bool(row[2])) if row else None
+
+def update_job(job_id: str, **fields):
+    columns = ", ".join(f"{column} = ?" for column in fields)
+    with cache_db.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+def get_job(job_id: str) -> Union[Dict[str, Any], None]:
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute('''
+            SELECT job_id, folder_path, clear_cache, status, stages_json, error, result_json,
+                   created_at, started_at, finished_at,
+                   (SELECT COUNT(*) FROM jobs AS ahead
+                    WHERE ahead.status = 'queued' AND ahead.created_at < jobs.created_at) AS queue_position
+            FROM jobs
+            WHERE job_id = ?
+        ''', (job_id,))
+        row = cursor.fetchone()
+    return dict(row) if row else None
 
 def get_pdf_files_from_folder(folder_path: str) -> List[str]:
     pdf_files = []
@@ -222,47 +1372,186 @@ def get_pdf_files_from_folder(folder_path: str) -> List[str]:
    
     return pdf_files
 
+def link_context(page_text: str, uri: str) -> str:
+    context_start = max(0, page_text.find(uri) - 50)
+    context_end = min(len(page_text), page_text.find(uri) + len(uri) + 50)
+    return page_text[context_start:context_end].strip()
+
+def extract_page_links(page, page_index: int, page_text: Union[str, None], source_file: str) -> List[Dict[str, Any]]:
+    # page_text may be None; the page is then decoded only if it carries links
+    links = []
+    if '/Annots' not in page:
+        return links
+    for annot in page['/Annots']:
+        annot_obj = annot.get_object()
+        if annot_obj.get('/Subtype') != '/Link' or '/A' not in annot_obj:
+            continue
+        uri = annot_obj['/A'].get('/URI')
+        if not uri:
+            continue
+        if page_text is None:
+            page_text = page.extract_text() or ""
+        links.append({
+            "url": uri,
+            "context": link_context(page_text, uri),
+            "page": page_index + 1,
+            "source_file": source_file
+        })
+    return links
+
+def iter_pdf_pages(reader: PdfReader, first_page: int = 0, page_links: Union[Dict[int, List], None] = None, source_file: str = ""):
+    # Pages are decoded only as the consumer advances, so a scan that stops
+    # early never pays for the rest of the document. When page_links is given,
+    # link annotations are collected from each page as it is decoded.
+    for page_index in range(first_page, len(reader.pages)):
+        page = reader.pages[page_index]
+        page_text = page.extract_text() or ""
+        if page_links is not None and page_index not in page_links:
+            try:
+                page_links[page_index] = extract_page_links(page, page_index, page_text, source_file)
+            except Exception as e:
+                logger.error(f"Error extracting hyperlinks from {source_file} page {page_index + 1}: {str(e)}")
+                page_links[page_index] = []
+        yield page_index, page_text
+
+def iter_text_chunks(pages, chunk_chars: int = TEXT_CHUNK_CHARS):
+    # Streams (page_index, chunk) pairs whose concatenation equals the
+    # whitespace-normalized text of the whole document. Each chunk is
+    # normalized on its own; a single separating space is carried across
+    # chunk and page boundaries.
+    emitted = False
+    space = False
+    for page_index, page_text in pages:
+        space = True
+        for pos in range(0, len(page_text), chunk_chars):
+            normalized = re.sub(r'\s+', ' ', page_text[pos:pos + chunk_chars])
+            if normalized.startswith(' '):
+                space = True
+            stripped = normalized.strip(' ')
+            if stripped:
+                yield page_index, (' ' + stripped if space and emitted else stripped)
+                emitted = True
+                space = False
+            if normalized.endswith(' '):
+                space = True
+
+class NoTextFoundError(ValueError):
+    pass
+
+def scan_for_table(chunks, start_header: str, end_header: str, max_chars: int = TABLE_MAX_CHARS) -> Tuple[str, int, int]:
+    # Finds the metrics table in a chunk stream while holding only a short
+    # tail (for headers split across chunks) and the table itself, and stops
+    # consuming as soon as the end header follows the start header, or once
+    # more than max_chars follow the start header without one.
+    overlap = max(len(start_header), len(end_header)) - 1
+    offset = 0
+    tail = ''
+    # (offset, page_index) of the chunks still overlapping the tail
+    recent_pages = []
+    table_parts = []
+    table_chars = 0
+    start_index = -1
+    start_page = None
+    for page_index, chunk in chunks:
+        recent_pages.append((offset, page_index))
+        window = tail + chunk
+        window_offset = offset - len(tail)
+        offset += len(chunk)
+        if start_index == -1:
+            found = window.find(start_header)
+            if found != -1:
+                start_index = window_offset + found
+                start_page = [page for chunk_offset, page in recent_pages if chunk_offset <= start_index][-1]
+                table_parts.append(window[found:])
+                table_chars += len(table_parts[-1])
+        else:
+            table_parts.append(chunk)
+            table_chars += len(chunk)
+        if start_index != -1:
+            found = window.find(end_header, max(0, start_index + len(start_header) - window_offset))
+            if found != -1:
+                end_index = window_offset + found
+                table_text = ''.join(table_parts)[:end_index - start_index].strip()
+                if not table_text:
+                    raise ValueError(f"No metrics table data found between headers")
+                return table_text, start_page, page_index
+            if table_chars > max_chars:
+                raise ValueError(f'Header {end_header} not found within {max_chars} characters of {start_header}')
+        tail = window[-overlap:]
+        while len(recent_pages) > 1 and recent_pages[1][0] <= offset - len(tail):
+            recent_pages.pop(0)
+
+    if offset == 0:
+        raise NoTextFoundError("No text found")
+    if start_index == -1:
+        raise ValueError(f'Header {start_header} not found in text')
+    raise ValueError(f'Header {end_header} not found in text')
+
+def ingest_pdf(pdf_path: str) -> Dict[str, Any]:
+    # Parse each PDF once: the metrics table slice and link annotations come
+    # from the same PdfReader. Text is streamed in bounded chunks and only the
+    # pages up to the end header are decoded for the table, starting from the
+    # page range the table was found in last time when one is indexed. Other
+    # pages are decoded only if they carry link annotations.
+    source_file = os.path.basename(pdf_path)
+    page_links = {}
+    with open(pdf_path, 'rb') as file:
+        reader = PdfReader(file)
+
+        table_text = None
+        page_hint = get_table_page_hint(pdf_path)
+        first_pages = [page_hint[0], 0] if page_hint and 0 < page_hint[0] < len(reader.pages) else [0]
+        for first_page in first_pages:
+            try:
+                table_text, start_page, end_page = scan_for_table(
+                    iter_text_chunks(iter_pdf_pages(reader, first_page, page_links, source_file)),
+                    START_HEADER_PATTERN, END_HEADER_PATTERN
+                )
+                if (start_page, end_page) != page_hint:
+                    store_table_page_hint(pdf_path, start_page, end_page)
+                break
+            except NoTextFoundError:
+                if first_page == 0:
+                    raise ValueError(f"No text extracted from {pdf_path}")
+            except ValueError as e:
+                if first_page == 0:
+                    logger.error(f"Failed to locate metrics table in {pdf_path}: {str(e)}")
+        logger.info(f"Decoded {len(page_links)} of {len(reader.pages)} page(s) to locate the metrics table in {source_file}")
+
+        hyperlinks = []
+        for page_index, page in enumerate(reader.pages):
+            if page_index not in page_links:
+                try:
+                    page_links[page_index] = extract_page_links(page, page_index, None, source_file)
+                except Exception as e:
+                    logger.error(f"Error extracting hyperlinks from {pdf_path} page {page_index + 1}: {str(e)}")
+                    continue
+            hyperlinks.extend(page_links[page_index])
+
+    return {
+        "source_file": source_file,
+        "table_text": table_text,
+        "hyperlinks": hyperlinks
+    }
+
 def extract_text_from_pdf(pdf_path: str) -> str:
     try:
         with open(pdf_path, 'rb') as file:
             reader = PdfReader(file)
-            text = ''
-            for page in reader.pages:
-                extracted = page.extract_text()
-                if extracted:
-                    text += extracted + '\n'
-            if not text.strip():
+            text = ''.join(chunk for _, chunk in iter_text_chunks(iter_pdf_pages(reader)))
+            if not text:
                 raise ValueError(f"No text extracted from {pdf_path}")
-            text = re.sub(r'\s+', ' ', text).strip()
             return text
     except Exception as e:
         logger.error(f"Error extracting text from {pdf_path}: {str(e)}")
         raise
 
 def extract_hyperlinks_from_pdf(pdf_path: str) -> List[Dict[str, str]]:
-    hyperlinks = []
     try:
-        with open(pdf_path, 'rb') as file:
-            reader = PdfReader(file)
-            for page_num, page in enumerate(reader.pages, start=1):
-                if '/Annots' in page:
-                    for annot in page['/Annots']:
-                        annot_obj = annot.get_object()
-                        if annot_obj['/Subtype'] == '/Link' and '/A' in annot_obj:
-                            uri = annot_obj['/A']['/URI']
-                            text = page.extract_text() or ""
-                            context_start = max(0, text.find(uri) - 50)
-                            context_end = min(len(text), text.find(uri) + len(uri) + 50)
-                            context = text[context_start:context_end].strip()
-                            hyperlinks.append({
-                                "url": uri,
-                                "context": context,
-                                "page": page_num,
-                                "source_file": os.path.basename(pdf_path)
-                            })
+        return ingest_pdf(pdf_path)["hyperlinks"]
     except Exception as e:
         logger.error(f"Error extracting hyperlinks from {pdf_path}: {str(e)}")
-    return hyperlinks
+        return []
 
 def locate_table(text: str, start_header: str, end_header: str) -> str:
     start_index = text.find(start_header)
@@ -276,17 +1565,50 @@ def locate_table(text: str, start_header: str, end_header: str) -> str:
         raise ValueError(f"No metrics table data found between headers")
     return table_text
 
-def evaluate_with_llm_judge(source_text: str, generated_report: str) -> Tuple[int, str]:
-    judge_llm = AzureChatOpenAI(
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_version=os.getenv("AZURE_API_VERSION"),
-        azure_deployment=os.getenv("DEPLOYMENT_NAME"),
-        temperature=0,
-        max_tokens=512,
-        timeout=None,
-    )
-   
+judge_llm = None
+judge_http_client = None
+judge_llm_lock = Lock()
+
+def get_judge_llm() -> AzureChatOpenAI:
+    # One long-lived judge client whose httpx pool is shared by every request.
+    # Created by the app lifespan; lazily here when the module is used directly.
+    global judge_llm, judge_http_client
+    with judge_llm_lock:
+        if judge_llm is None:
+            judge_http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=JUDGE_MAX_CONNECTIONS, max_keepalive_connections=JUDGE_MAX_CONNECTIONS),
+                timeout=JUDGE_TIMEOUT_SECONDS,
+            )
+            judge_llm = AzureChatOpenAI(
+                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_version=os.getenv("AZURE_API_VERSION"),
+                azure_deployment=os.getenv("DEPLOYMENT_NAME"),
+                temperature=0,
+                max_tokens=512,
+                timeout=JUDGE_TIMEOUT_SECONDS,
+                http_async_client=judge_http_client,
+            )
+            logger.info(f"Judge client ready (pool of {JUDGE_MAX_CONNECTIONS} connections)")
+        return judge_llm
+
+async def close_judge_llm():
+    global judge_llm, judge_http_client
+    with judge_llm_lock:
+        http_client, judge_http_client, judge_llm = judge_http_client, None, None
+    if http_client is not None:
+        await http_client.aclose()
+
+def parse_judge_score(response_text: str) -> Union[int, None]:
+    score_line = next((line for line in response_text.split('\n') if line.startswith('Score:')), None)
+    try:
+        return int(score_line.split(':')[1].strip()) if score_line else None
+    except ValueError:
+        return None
+
+async def evaluate_with_llm_judge(source_text: str, generated_report: str, budget: Union[PromptBudget, None] = None) -> Tuple[int, str]:
+    judge = get_judge_llm()
+
     prompt = f"""Act as an impartial judge evaluating report quality. You will be given:
 1. ORIGINAL SOURCE TEXT (extracted from PDF)
 2. GENERATED REPORT (created by AI)
@@ -311,14 +1633,29 @@ Evaluation: [your evaluation]
 
 Your evaluation:"""
    
+    if budget:
+        budget.record("judge", template=prompt.replace(source_text, "").replace(generated_report, ""),
+                      source=source_text, report=generated_report)
+
+    async def invoke_judge():
+        response = await asyncio.wait_for(judge.ainvoke(prompt), timeout=JUDGE_TIMEOUT_SECONDS)
+        return response.content
+
+    response_text = ""
     try:
-        response = judge_llm.invoke(prompt)
-        response_text = response.content
-        score_line = next(line for line in response_text.split('\n') if line.startswith('Score:'))
-        score = int(score_line.split(':')[1].strip())
+        # Only replies whose score parses are cached, so an unparseable reply
+        # is asked for again instead of replayed as "Could not parse evaluation".
+        response_text = await cached_llm_acall(os.getenv("DEPLOYMENT_NAME"), 0, prompt, invoke_judge,
+                                               usable=lambda text: parse_judge_score(text) is not None)
+        score = parse_judge_score(response_text)
+        if score is None:
+            raise ValueError("No parseable 'Score:' line")
         eval_lines = [line for line in response_text.split('\n') if line.startswith('Evaluation:')]
         evaluation = ' '.join(line.split('Evaluation:')[1].strip() for line in eval_lines)
         return score, evaluation
+    except asyncio.TimeoutError:
+        logger.error(f"Judge call timed out after {JUDGE_TIMEOUT_SECONDS}s")
+        return 50, "Evaluation timed out"
     except Exception as e:
         logger.error(f"Error parsing judge response: {e}\nResponse was:\n{response_text}")
         return 50, "Could not parse evaluation"
@@ -359,7 +1696,7 @@ def validate_metrics(metrics: Dict[str, Any]) -> bool:
                             return False
                         if item_dict['value'] > 0:
                             has_non_zero = True
-                        if item_dict['status'] not in ['ON TRACK', 'MEDIUM RISK', 'RISK', 'NEEDS REVIEW']:
+                        if item_dict['status'] not in STATUS_VALUES + [UNKNOWN_STATUS]:
                             logger.warning(f"Invalid status in {sub} item for {metric}: {item}")
                             return False
                         if 'trend' in item_dict and not re.match(r'^(↑|↓)\s*\(\d+\.\d+%\)|→$', item_dict['trend']):
@@ -395,7 +1732,7 @@ def validate_metrics(metrics: Dict[str, Any]) -> bool:
                         if not isinstance(item_dict['fail_count'], (int, float)) or item_dict['fail_count'] < 0:
                             logger.warning(f"Invalid fail_count in {client} item for {metric}: {item}")
                             return False
-                        if item_dict['status'] not in ['ON TRACK', 'MEDIUM RISK', 'RISK', 'NEEDS REVIEW']:
+                        if item_dict['status'] not in STATUS_VALUES + [UNKNOWN_STATUS]:
                             logger.warning(f"Invalid status in {client} item for {metric}: {item}")
                             return False
                         if 'trend' in item_dict and not re.match(r'^(↑|↓)\s*\(\d+\.\d+%\)|→$', item_dict['trend']):
@@ -423,7 +1760,7 @@ def validate_metrics(metrics: Dict[str, Any]) -> bool:
                         return False
                     if item_dict['value'] > 0:
                         has_non_zero = True
-                    if item_dict['status'] not in ['ON TRACK', 'MEDIUM RISK', 'RISK', 'NEEDS REVIEW']:
+                    if item_dict['status'] not in STATUS_VALUES + [UNKNOWN_STATUS]:
                         logger.warning(f"Invalid status in item for {metric}: {item}")
                         return False
                     if 'trend' in item_dict and not re.match(r'^(↑|↓)\s*\(\d+\.\d+%\)|→$', item_dict['trend']):
@@ -448,7 +1785,11 @@ def process_task_output(raw_output: str, fallback_versions: List[str]) -> Dict:
     if not validate_metrics(data):
         logger.error(f"Validation failed for processed output: {json.dumps(data, indent=2)[:200]}...")
         raise ValueError("Invalid or incomplete metrics data")
-    # Validate and correct trends
+    return compute_trends(data)
+
+def compute_trends(data: Dict) -> Dict:
+    # Native trend engine: sets 'trend' on every item and 'pass_rate' on UAT
+    # items, in place, from the version-sorted values.
     for metric, metric_data in data['metrics'].items():
         if metric in EXPECTED_METRICS[:5]:  # ATLS/BTLS metrics
             for sub in ['ATLS', 'BTLS']:
@@ -515,26 +1856,65 @@ def process_task_output(raw_output: str, fallback_versions: List[str]) -> Dict:
                             items[i]['trend'] = f"↓ ({abs(pct_change):.1f}%)"
     return data
 
-def setup_crew(extracted_text: str, versions: List[str], llm=llm) -> tuple:
-    structurer = Agent(
-        role="Data Architect",
-        goal="Structure raw release data into VALID JSON format",
-        backstory="Expert in transforming unstructured data into clean JSON structures",
-        llm=llm,
-        verbose=True,
-        memory=True,
-    )
-
-    # Ensure we have at least 2 versions for comparison; repeat the last one if needed
-    if len(versions) < 2:
-        raise ValueError("At least two versions are required for analysis")
-    versions_for_example = versions[:3] if len(versions) >= 3 else versions + [versions[-1]] * (3 - len(versions))
-
-    validated_structure_task = Task(
-        description=f"""Convert this release data to STRICT JSON:
-{extracted_text}
-
-RULES:
+TABLE_COLUMNS_PATTERN = r'Metric\s+Previous\s*\([^)]*\)\s+Current\s*\([^)]*\)\s+Status\s*'
+
+def compact_table_text(table_text: str) -> str:
+    # Drops the header and column row repeated in every file and repairs
+    # labels split by PDF extraction ("T est Coverage").
+    text = unicodedata.normalize('NFKC', table_text)
+    if text.startswith(START_HEADER_PATTERN):
+        text = text[len(START_HEADER_PATTERN):]
+    text = re.sub(TABLE_COLUMNS_PATTERN, '', text, count=1, flags=re.IGNORECASE)
+    labels = sorted(EXPECTED_METRICS + OTHER_TABLE_LABELS + UAT_CLIENTS, key=len, reverse=True)
+    canonical = {re.sub(r'\s+', '', label).lower(): label for label in labels}
+    pattern = '|'.join(table_label_pattern(label) for label in labels)
+    text = re.sub(pattern, lambda m: canonical[re.sub(r'\s+', '', m.group(0)).lower()], text, flags=re.IGNORECASE)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def release_sort_key(version: Union[str, None]) -> List[int]:
+    return [int(part) for part in (version or "").split('.') if part.isdigit()]
+
+def encode_source_text(extracted_texts: List[Tuple[str, str]], versions: List[str],
+                       token_cap: int = PROMPT_SOURCE_TOKEN_CAP) -> Tuple[str, List[str]]:
+    # Compact source for the structurer and judge prompts: the table header is
+    # stated once and each file, oldest release first, contributes one line of rows.
+    # Returns the text and the releases it covers, which the rest of the
+    # analysis must be narrowed to.
+    header = f"{START_HEADER_PATTERN} one table per file, columns: Metric, Previous, Current, Status"
+    files = sorted(extracted_texts, key=lambda item: release_sort_key(extract_version(item[0])))
+    blocks = [f"File: {name} (current release {extract_version(name)})\n{compact_table_text(text)}" for name, text in files]
+    tokens = [count_tokens(block) for block in blocks]
+    total = count_tokens(header) + sum(tokens)
+    dropped = 0
+    # Over the cap, drop the oldest releases first but keep two to compare
+    while total > token_cap and len(blocks) - dropped > 2:
+        total -= tokens[dropped]
+        dropped += 1
+    if total > token_cap:
+        raise ValueError(f"Metrics tables of the two newest releases are {total} tokens, over the "
+                         f"{token_cap} token cap (PROMPT_SOURCE_TOKEN_CAP)")
+    kept_versions = versions
+    if dropped:
+        # The oldest kept file still carries its previous release in the Previous column
+        ordered = sorted(versions, key=release_sort_key)
+        oldest = extract_version(files[dropped][0])
+        if oldest in ordered:
+            floor = release_sort_key(ordered[max(ordered.index(oldest) - 1, 0)])
+            kept_versions = [v for v in versions if release_sort_key(v) >= floor]
+        logger.warning(f"Source text over the {token_cap} token cap; dropped {dropped} oldest file(s), "
+                       f"analysing releases {kept_versions} of {versions}")
+    return "\n".join([header] + blocks[dropped:]), kept_versions
+
+# Prompt templates only depend on the release versions, so each is built
+# once per version set.
+def compact_prompt(text: str) -> str:
+    # Drops the indentation of JSON example lines; rule lists keep theirs
+    return re.sub(r'(?m)^[ \t]+(?=[{}\[\]"])', '', text)
+
+@lru_cache(maxsize=32)
+def structure_prompt_rules(versions: Tuple[str, ...]) -> str:
+    versions_for_example = versions[:3] if len(versions) >= 3 else versions + (versions[-1],) * (3 - len(versions))
+    return compact_prompt(f"""RULES:
 1. Output MUST be valid JSON only
 2. Use this EXACT structure:
 {{
@@ -598,29 +1978,12 @@ EXAMPLE:
         }},
         ...
     }}
-}}""",
-        agent=structurer,
-        async_execution=False,
-        expected_output="Valid JSON string with no extra text",
-        callback=lambda output: (
-            logger.info(f"Structure task output type: {type(output.raw)}, content: {output.raw if isinstance(output.raw, str) else output.raw}"),
-            setattr(shared_state, 'metrics', process_task_output(output.raw, versions))
-        )
-    )
-
-    analyst = Agent(
-        role="Trend Analyst",
-        goal="Add accurate trends to metrics data and maintain valid JSON",
-        backstory="Data scientist specializing in metric analysis",
-        llm=llm,
-        verbose=True,
-        memory=True,
-    )
+}}""")
 
-    analysis_task = Task(
-        description=f"""Enhance metrics JSON with trends:
-1. Input is JSON from Data Structurer
-2. Add 'trend' field to each metric item
+@lru_cache(maxsize=32)
+def analysis_prompt_rules(versions: Tuple[str, ...]) -> str:
+    versions_for_example = versions[:3] if len(versions) >= 3 else versions + (versions[-1],) * (3 - len(versions))
+    return compact_prompt(f"""2. Add 'trend' field to each metric item
 3. Output MUST be valid JSON
 4. For metrics except Customer Specific Testing (UAT):
    - Sort items by version ({', '.join(f'"{v}"' for v in versions)})
@@ -715,28 +2078,11 @@ EXAMPLE OUTPUT:
         ...
     }}
 }}
-Only return valid JSON.""",
-        agent=analyst,
-        async_execution=True,
-        context=[validated_structure_task],
-        expected_output="Valid JSON string with trend analysis",
-        callback=lambda output: (
-            logger.info(f"Analysis task output type: {type(output.raw)}, content: {output.raw if isinstance(output.raw, str) else output.raw}"),
-            setattr(shared_state, 'metrics', process_task_output(output.raw, versions))
-        )
-    )
-
-    visualizer = Agent(
-        role="Data Visualizer",
-        goal="Generate consistent visualizations for all metrics",
-        backstory="Expert in generating Python plots for software metrics",
-        llm=llm,
-        verbose=True,
-        memory=True,
-    )
+Only return valid JSON.""")
 
-    visualization_task = Task(
-        description=f"""Create a standalone Python script that:
+@lru_cache(maxsize=32)
+def visualization_prompt(versions: Tuple[str, ...]) -> str:
+    return compact_prompt(f"""Create a standalone Python script that:
 1. Accepts the provided 'metrics' JSON structure as input.
 2. Generates exactly 10 visualizations for the following metrics, using the specified chart types:
    - Open ALL RRR Defects (ATLS and BTLS): Grouped bar chart comparing ATLS and BTLS across releases.
@@ -751,7 +2097,7 @@ Only return valid JSON.""",
    - Regression Issues: Bar chart showing values across releases.
 3. If Pass/Fail metrics are present in the JSON, generate additional grouped bar charts comparing Pass vs. Fail counts across releases.
 4. Each plot must use: plt.figure(figsize=(8,5), dpi=120).
-5. Save each chart as a PNG in 'visualizations/' directory with descriptive filenames (e.g., 'open_rrr_defects_atls_btls.png', 'e2e_test_coverage.png').
+5. Save each chart as a PNG in the directory given by the predefined variable 'output_dir' with descriptive filenames (e.g., os.path.join(output_dir, 'open_rrr_defects_atls_btls.png'), os.path.join(output_dir, 'e2e_test_coverage.png')).
 6. Include error handling for missing or malformed data, ensuring all specified charts are generated.
 7. Log each chart generation attempt to 'visualization.log' for debugging.
 8. Output ONLY the Python code, with no markdown or explanation text.
@@ -763,79 +2109,19 @@ Only return valid JSON.""",
     coverage_metrics = {EXPECTED_METRICS[5:8]}
     other_metrics = {EXPECTED_METRICS[8:10]}
     Do not use a variable named 'expected_metrics'.
-13. Use versions: {', '.join(f'"{v}"' for v in versions)}""",
-        agent=visualizer,
-        context=[analysis_task],
-        expected_output="Python script only"
-    )
-
-    reporter = Agent(
-        role="Technical Writer",
-        goal="Generate a professional markdown report",
-        backstory="Writes structured software metrics reports",
-        llm=llm,
-        verbose=True,
-        memory=True,
-    )
+13. Use versions: {', '.join(f'"{v}"' for v in versions)}""")
 
-    overview_task = Task(
-        description=f"""Write ONLY the following Markdown section:
+@lru_cache(maxsize=32)
+def section_prompt(section: str, versions: Tuple[str, ...]) -> str:
+    prompts = {
+        "Overview": f"""Write ONLY the following Markdown section:
 ## Overview
 - Provide a 3-4 sentence comprehensive summary of release health, covering overall stability, notable improvements, and any concerning patterns observed across releases {', '.join(versions)}
 - Explicitly list all analyzed releases
 - Include 2-3 notable metric highlights with specific version comparisons where relevant
 - Mention any significant deviations from expected patterns
 Only output this section.""",
-        agent=reporter,
-        context=[analysis_task],
-        expected_output="Detailed markdown for Overview section"
-    )
-
-    metrics_summary_task = Task(
-        description=f"""Write ONLY the '## Metrics Summary' section with the following order:
-### Delivery Against Requirements  
-### Open ALL RRR Defects (ATLS)  
-### Open ALL RRR Defects (BTLS)  
-### Open Security Defects (ATLS)  
-### Open Security Defects (BTLS)  
-### All Open Defects (T-1) (ATLS)  
-### All Open Defects (T-1) (BTLS)  
-### All Security Open Defects (ATLS)  
-### All Security Open Defects (BTLS)  
-### Customer Specific Testing (UAT)  
-#### RBS  
-#### Tesco  
-#### Belk  
-### Load/Performance  
-#### ATLS  
-#### BTLS
-### E2E Test Coverage  
-### Automation Test Coverage  
-### Unit Test Coverage  
-### Defect Closure Rate (ATLS)  
-### Regression Issues  
-
-STRICT RULES:
-- For Customer Specific Testing (UAT), generate tables for each client with the following columns: Release | Pass Count | Fail Count | Pass Rate (%) | Trend | Status
-- For other metrics, use existing table formats
-- Use only these statuses: ON TRACK, MEDIUM RISK, RISK, NEEDS REVIEW
-- Use only these trend formats: ↑ (X%), ↓ (Y%), →
-- No missing releases or extra formatting
-EXAMPLE FOR UAT:
-#### RBS
-| Release | Pass Count | Fail Count | Pass Rate (%) | Trend      | Status       |
-|---------|------------|------------|---------------|------------|--------------|
-| {versions_for_example[0]}    | 50         | 5          | 90.9          | →          | ON TRACK     |
-| {versions_for_example[1]}    | 48         | 6          | 88.9          | ↓ (2.0%)   | MEDIUM RISK  |
-| {versions_for_example[2]}    | 52         | 4          | 92.9          | ↑ (4.0%)   | ON TRACK     |
-Only output this section.""",
-        agent=reporter,
-        context=[analysis_task],
-        expected_output="Markdown for Metrics Summary"
-    )
-
-    key_findings_task = Task(
-        description=f"""Generate ONLY this Markdown section:
+        "Key Findings": f"""Generate ONLY this Markdown section:
 ## Key Findings
 1. First finding (2-3 sentences explaining the observation with specific metric references and version comparisons across {', '.join(versions)})
 2. Second finding (2-3 sentences with quantitative data points from the metrics where applicable)
@@ -846,13 +2132,7 @@ Only output this section.""",
 7. Seventh finding (2-3 sentences summarizing defect management effectiveness)
 
 Maintain professional, analytical tone while being specific.""",
-        agent=reporter,
-        context=[analysis_task],
-        expected_output="Detailed markdown bullet list"
-    )
-
-    recommendations_task = Task(
-        description="""Generate ONLY this Markdown section:
+        "Recommendations": f"""Generate ONLY this Markdown section:
 ## Recommendations
 1. First recommendation (2-3 actionable sentences with specific metrics or areas to address)
 2. Second recommendation (2-3 sentences about security improvements with version targets)
@@ -863,57 +2143,121 @@ Maintain professional, analytical tone while being specific.""",
 7. Seventh recommendation (2-3 sentences about monitoring improvements)
 
 Each recommendation should be specific, measurable, and tied to the findings.""",
-        agent=reporter,
-        context=[analysis_task],
-        expected_output="Detailed markdown bullet list"
-    )
-
-    assemble_report_task = Task(
-        description="""Assemble the final markdown report in this exact structure:
-
-# Software Metrics Report  
-
-## Overview  
-[Insert from Overview Task]  
+    }
+    return prompts[section]
 
----  
+def setup_data_crew(extracted_text: str, versions: List[str], ctx: PipelineContext, llm=llm,
+                    parsed_metrics: Union[Dict, None] = None) -> Union[Crew, None]:
+    structurer = Agent(
+        role="Data Architect",
+        goal="Structure raw release data into VALID JSON format",
+        backstory="Expert in transforming unstructured data into clean JSON structures",
+        llm=llm,
+        verbose=True,
+        memory=True,
+    )
 
-## Metrics Summary  
-[Insert from Metrics Summary Task]  
+    # Ensure we have at least 2 versions for comparison
+    if len(versions) < 2:
+        raise ValueError("At least two versions are required for analysis")
 
----  
+    validated_structure_task = Task(
+        description=f"""Convert this release data to STRICT JSON:
+{extracted_text}
 
-## Key Findings  
-[Insert from Key Findings Task]  
+{structure_prompt_rules(tuple(versions))}""",
+        agent=structurer,
+        async_execution=False,
+        expected_output="Valid JSON string with no extra text",
+        callback=lambda output: (
+            logger.info(f"Structure task output type: {type(output.raw)}, content: {output.raw if isinstance(output.raw, str) else output.raw}"),
+            ctx.set_metrics(process_task_output(output.raw, versions)),
+            # Downstream tasks read this output as context; hand them the validated metrics with trends
+            setattr(output, 'raw', json.dumps(ctx.metrics, ensure_ascii=False))
+        )
+    )
 
----  
+    analyst = Agent(
+        role="Trend Analyst",
+        goal="Add accurate trends to metrics data and maintain valid JSON",
+        backstory="Data scientist specializing in metric analysis",
+        llm=llm,
+        verbose=True,
+        memory=True,
+    )
 
-## Recommendations  
-[Insert from Recommendations Task]
+    if parsed_metrics:
+        ctx.set_metrics(compute_trends(deepcopy(parsed_metrics)))
+        metrics_input = f"""Input is this JSON:
+{json.dumps(parsed_metrics)}"""
+    else:
+        metrics_input = "Input is JSON from Data Structurer"
 
-Do NOT alter content. Just combine with correct formatting.""",
-        agent=reporter,
-        context=[
-            overview_task,
-            metrics_summary_task,
-            key_findings_task,
-            recommendations_task
-        ],
-        expected_output="Full markdown report"
+    analysis_task = Task(
+        description=f"""Enhance metrics JSON with trends:
+1. {metrics_input}
+{analysis_prompt_rules(tuple(versions))}""",
+        agent=analyst,
+        async_execution=True,
+        context=[] if parsed_metrics else [validated_structure_task],
+        expected_output="Valid JSON string with trend analysis",
+        callback=lambda output: (
+            logger.info(f"Analysis task output type: {type(output.raw)}, content: {output.raw if isinstance(output.raw, str) else output.raw}"),
+            ctx.set_metrics(process_task_output(output.raw, versions))
+        )
     )
 
+    data_tasks = [] if parsed_metrics else [validated_structure_task]
+    if USE_LLM_TREND_ANALYST:
+        data_tasks.append(analysis_task)
+    if not parsed_metrics:
+        ctx.budget.record("structurer", template=structure_prompt_rules(tuple(versions)), source=extracted_text)
+    if USE_LLM_TREND_ANALYST:
+        ctx.budget.record("analyst", template=analysis_prompt_rules(tuple(versions)), metrics=metrics_input)
     data_crew = Crew(
-        agents=[structurer, analyst],
-        tasks=[validated_structure_task, analysis_task],
+        agents=list({id(task.agent): task.agent for task in data_tasks}.values()),
+        tasks=data_tasks,
         process=Process.sequential,
         verbose=True
+    ) if data_tasks else None
+
+    check_crew_tasks(data_crew, "data_crew")
+    return data_crew
+
+def check_crew_tasks(crew, name: str):
+    if crew is None:
+        logger.info(f"{name} skipped, no LLM tasks needed")
+        return
+    for i, task in enumerate(crew.tasks):
+        if not isinstance(task, Task):
+            logger.error(f"Invalid task in {name} at index {i}: {task}")
+            raise ValueError(f"Task in {name} is not a Task object")
+        logger.info(f"{name} task {i} async_execution: {task.async_execution}")
+
+def metrics_prompt_block(metrics: Dict[str, Any]) -> str:
+    return f"""
+Metrics JSON:
+{json.dumps(metrics, ensure_ascii=False, separators=(',', ':'))}
+"""
+
+def setup_viz_crew(metrics: Dict[str, Any], versions: List[str], ctx: PipelineContext, llm=llm) -> Crew:
+    metrics_block = metrics_prompt_block(metrics)
+    ctx.budget.record("visualizer", template=visualization_prompt(tuple(versions)), metrics=metrics_block)
+
+    visualizer = Agent(
+        role="Data Visualizer",
+        goal="Generate consistent visualizations for all metrics",
+        backstory="Expert in generating Python plots for software metrics",
+        llm=llm,
+        verbose=True,
+        memory=True,
     )
 
-    report_crew = Crew(
-        agents=[reporter],
-        tasks=[overview_task, metrics_summary_task, key_findings_task, recommendations_task, assemble_report_task],
-        process=Process.sequential,
-        verbose=True
+    visualization_task = Task(
+        description=f"""{metrics_block}{visualization_prompt(tuple(versions))}""",
+        agent=visualizer,
+        context=[],
+        expected_output="Python script only"
     )
 
     viz_crew = Crew(
@@ -923,14 +2267,183 @@ Do NOT alter content. Just combine with correct formatting.""",
         verbose=True
     )
 
-    for crew, name in [(data_crew, "data_crew"), (report_crew, "report_crew"), (viz_crew, "viz_crew")]:
-        for i, task in enumerate(crew.tasks):
-            if not isinstance(task, Task):
-                logger.error(f"Invalid task in {name} at index {i}: {task}")
-                raise ValueError(f"Task in {name} is not a Task object")
-            logger.info(f"{name} task {i} async_execution: {task.async_execution}")
+    check_crew_tasks(viz_crew, "viz_crew")
+    return viz_crew
+
+def setup_report_crews(metrics: Dict[str, Any], versions: List[str], ctx: PipelineContext, llm=llm) -> Dict[str, Crew]:
+    # Built from the validated metrics so that a rejected report can be
+    # regenerated without rerunning the metrics stage.
+    metrics_block = metrics_prompt_block(metrics)
+
+    # One writer per section: the sections are generated concurrently, each
+    # in its own crew, and a crew takes ownership of its agents.
+    def new_reporter():
+        return Agent(
+            role="Technical Writer",
+            goal="Generate a professional markdown report",
+            backstory="Writes structured software metrics reports",
+            llm=llm,
+            verbose=True,
+            memory=True,
+        )
+
+    overview_task = Task(
+        description=f"""{metrics_block}{section_prompt("Overview", tuple(versions))}""",
+        agent=new_reporter(),
+        context=[],
+        expected_output="Detailed markdown for Overview section"
+    )
+
+    key_findings_task = Task(
+        description=f"""{metrics_block}{section_prompt("Key Findings", tuple(versions))}""",
+        agent=new_reporter(),
+        context=[],
+        expected_output="Detailed markdown bullet list"
+    )
+
+    recommendations_task = Task(
+        description=f"""{metrics_block}{section_prompt("Recommendations", tuple(versions))}""",
+        agent=new_reporter(),
+        context=[],
+        expected_output="Detailed markdown bullet list"
+    )
 
-    return data_crew, report_crew, viz_crew
+    # Sections don't depend on each other; each gets its own crew so they can
+    # be kicked off concurrently and assembled by assemble_report. The Metrics
+    # Summary is rendered from the metrics by render_metrics_summary instead.
+    report_crews = {
+        section: Crew(
+            agents=[task.agent],
+            tasks=[task],
+            process=Process.sequential,
+            verbose=True
+        )
+        for section, task in zip(NARRATIVE_SECTIONS, [overview_task, key_findings_task, recommendations_task])
+    }
+
+    for section, crew in report_crews.items():
+        check_crew_tasks(crew, f"report_crew[{section}]")
+        ctx.budget.record(f"report[{section}]", template=section_prompt(section, tuple(versions)), metrics=metrics_block)
+    return report_crews
+
+def extract_version(file_name: str) -> Union[str, None]:
+    match = re.search(r'(\d+\.\d+)(?:\s|\.)', file_name)
+    return match.group(1) if match else None
+
+def parse_table_numbers(segment: str) -> List[Union[int, float]]:
+    return [float(n) if '.' in n else int(n) for n in re.findall(r'(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])', segment)]
+
+def parse_table_status(segment: str) -> Union[str, None]:
+    match = re.search(r'MEDIUM RISK|NEEDS REVIEW|ON TRACK|RISK', segment, re.IGNORECASE)
+    return match.group(0).upper() if match else None
+
+def table_label_pattern(label: str) -> str:
+    # PDF text extraction splits words ("T est", "Speci fic"), so allow a
+    # stray space between any two characters of a label.
+    return r'\s?'.join(r'\s*' if c.isspace() else re.escape(c) for c in label)
+
+def split_table_segments(text: str, labels: List[str]) -> Dict[str, str]:
+    # Maps each label to the text between it and the next label
+    pattern = '|'.join(table_label_pattern(label) for label in sorted(labels, key=len, reverse=True))
+    matches = list(re.finditer(pattern, text, re.IGNORECASE))
+    segments = {}
+    canonical = {re.sub(r'\s+', '', label).lower(): label for label in labels}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        segments.setdefault(canonical[re.sub(r'\s+', '', match.group(0)).lower()], text[match.end():end])
+    return segments
+
+def parse_metrics_table(extracted_texts: List[Tuple[str, str]], versions: List[str]) -> Union[Dict, None]:
+    # Rule-based structuring of the "Release Readiness Critical Metrics
+    # (Previous/Current)" table. Each file contributes its current values for
+    # its own release and, where a release has no file of its own, its
+    # previous values for the release before it. Returns None unless every
+    # metric is covered for every version and validate_metrics accepts it.
+    current = {}
+    previous = {}
+    for source_file, table_text in extracted_texts:
+        version = extract_version(source_file)
+        if version not in versions:
+            continue
+        index = versions.index(version)
+        prev_version = versions[index - 1] if index > 0 else None
+        segments = split_table_segments(unicodedata.normalize('NFKC', table_text), EXPECTED_METRICS + OTHER_TABLE_LABELS)
+        for metric in EXPECTED_METRICS:
+            segment = segments.get(metric)
+            if segment is None:
+                continue
+            if metric in EXPECTED_METRICS[:5] or metric == "Customer Specific Testing (UAT)":
+                subs = ['ATLS', 'BTLS'] if metric in EXPECTED_METRICS[:5] else UAT_CLIENTS
+                parts = split_table_segments(segment, subs)
+            else:
+                parts = {None: segment}
+            for sub, part in parts.items():
+                key = (metric, sub)
+                status = parse_table_status(part) or parse_table_status(segment) or UNKNOWN_STATUS
+                if metric == "Customer Specific Testing (UAT)":
+                    passes = [int(n) for n in re.findall(r'Pass\w*\W{0,3}(\d+)', part, re.IGNORECASE)]
+                    fails = [int(n) for n in re.findall(r'Fail\w*\W{0,3}(\d+)', part, re.IGNORECASE)]
+                    if not passes or len(passes) != len(fails):
+                        numbers = [int(n) for n in parse_table_numbers(part)]
+                        if not numbers or len(numbers) % 2:
+                            continue
+                        passes, fails = numbers[0::2], numbers[1::2]
+                    items = [{"pass_count": p, "fail_count": f} for p, f in zip(passes, fails)]
+                else:
+                    items = [{"value": n} for n in parse_table_numbers(part)]
+                if not items:
+                    continue
+                current.setdefault(key, {})[version] = {"version": version, **items[-1], "status": status}
+                if prev_version and len(items) >= 2:
+                    previous.setdefault(key, {})[prev_version] = {"version": prev_version, **items[-2], "status": UNKNOWN_STATUS}
+
+    def series(key):
+        by_version = dict(previous.get(key, {}))
+        by_version.update(current.get(key, {}))
+        if any(v not in by_version for v in versions):
+            return None
+        return [by_version[v] for v in versions]
+
+    data = {"metrics": {}}
+    for metric in EXPECTED_METRICS:
+        if metric in EXPECTED_METRICS[:5] or metric == "Customer Specific Testing (UAT)":
+            subs = ['ATLS', 'BTLS'] if metric in EXPECTED_METRICS[:5] else UAT_CLIENTS
+            data["metrics"][metric] = {sub: series((metric, sub)) for sub in subs}
+            missing = [sub for sub, items in data["metrics"][metric].items() if items is None]
+        else:
+            data["metrics"][metric] = series((metric, None))
+            missing = [metric] if data["metrics"][metric] is None else []
+        if missing:
+            logger.info(f"Table parser could not cover {metric} {missing} for all versions, deferring to LLM structurer")
+            return None
+    if not validate_metrics(data):
+        logger.info("Table parser output failed validation, deferring to LLM structurer")
+        return None
+    return data
+
+def parse_delivery_against_requirements(extracted_texts: List[Tuple[str, str]], versions: List[str]) -> List[Dict]:
+    # Delivery Against Requirements rows for the Metrics Summary, taken from
+    # the same table as parse_metrics_table. The row may hold numbers or a
+    # short remark; releases the table does not cover are left out.
+    rows = {}
+    for source_file, table_text in extracted_texts:
+        version = extract_version(source_file)
+        if version not in versions:
+            continue
+        index = versions.index(version)
+        segment = split_table_segments(unicodedata.normalize('NFKC', table_text), EXPECTED_METRICS + OTHER_TABLE_LABELS).get("Delivery Against Requirements")
+        if segment is None:
+            continue
+        values = parse_table_numbers(segment)
+        if not values:
+            remark = re.sub(r'\s+', ' ', re.sub(r'MEDIUM RISK|NEEDS REVIEW|ON TRACK|RISK', '', segment, flags=re.IGNORECASE)).strip()
+            values = [remark[:80]] if remark else []
+        if not values:
+            continue
+        rows[version] = {"version": version, "value": values[-1], "status": parse_table_status(segment) or UNKNOWN_STATUS}
+        if index > 0 and len(values) >= 2:
+            rows.setdefault(versions[index - 1], {"version": versions[index - 1], "value": values[-2], "status": UNKNOWN_STATUS})
+    return [rows[v] for v in versions if v in rows]
 
 def clean_json_output(raw_output: str, fallback_versions: List[str]) -> dict:
     logger.info(f"Raw analysis output: {raw_output[:200]}...")
@@ -1028,6 +2541,84 @@ def clean_json_output(raw_output: str, fallback_versions: List[str]) -> dict:
    
 #     return cleaned.encode('utf-8').decode('utf-8')
 
+def section_body(section: str, body: Union[str, None]) -> str:
+    # Section text without code fences or the section's own header
+    body = re.sub(r'^\s*```(?:markdown)?\s*\n|\n\s*```\s*$', '', body or '').strip()
+    return re.sub(rf'^#{{1,6}}\s*{re.escape(section)}\s*\n?', '', body, flags=re.IGNORECASE).strip()
+
+def assemble_report(sections: Dict[str, str]) -> str:
+    # Deterministic replacement for the LLM assembly step: every section gets
+    # exactly one of the headers validate_report checks for.
+    parts = []
+    for section in REPORT_SECTIONS:
+        parts.append(f"## {section}\n\n{section_body(section, sections.get(section))}")
+    return "# Software Metrics Report\n\n" + "\n\n---\n\n".join(parts) + "\n"
+
+def split_report_sections(report: str) -> Dict[str, str]:
+    # Inverse of assemble_report: body text under each "## <section>" header
+    positions = sorted((report.find(f"## {section}"), section) for section in REPORT_SECTIONS if f"## {section}" in report)
+    sections = {}
+    for i, (start, section) in enumerate(positions):
+        end = positions[i + 1][0] if i + 1 < len(positions) else len(report)
+        body = report[start + len(f"## {section}"):end].strip()
+        sections[section] = re.sub(r'(\s*-{3,}\s*)+$', '', body).strip()
+    return sections
+
+METRICS_SUMMARY_TABLE = """| Release | Value | Trend | Status |
+|---------|-------|-------|--------|
+{rows}"""
+
+UAT_SUMMARY_TABLE = """| Release | Pass Count | Fail Count | Pass Rate (%) | Trend | Status |
+|---------|------------|------------|---------------|-------|--------|
+{rows}"""
+
+def format_metric_value(value: Any) -> str:
+    return f"{value:g}" if isinstance(value, (int, float)) else str(value)
+
+def format_status(status: str) -> str:
+    return "n/a" if status == UNKNOWN_STATUS else f"**{status}**"
+
+def render_value_table(items: List[Dict]) -> str:
+    rows = "\n".join(
+        f"| {item['version']} | {format_metric_value(item['value'])} | {item.get('trend', '→')} | {format_status(item['status'])} |"
+        for item in sorted(items, key=lambda x: x['version'])
+    )
+    return METRICS_SUMMARY_TABLE.format(rows=rows)
+
+def render_uat_table(items: List[Dict]) -> str:
+    rows = []
+    for item in sorted(items, key=lambda x: x['version']):
+        total = item['pass_count'] + item['fail_count']
+        pass_rate = item.get('pass_rate', item['pass_count'] / total * 100 if total > 0 else 0)
+        rows.append(
+            f"| {item['version']} | {format_metric_value(item['pass_count'])} | {format_metric_value(item['fail_count'])} "
+            f"| {pass_rate:.1f} | {item.get('trend', '→')} | {format_status(item['status'])} |"
+        )
+    return UAT_SUMMARY_TABLE.format(rows="\n".join(rows))
+
+def render_metrics_summary(metrics: Dict) -> str:
+    # Metrics Summary section body rendered from validated metrics, in the
+    # order the report has always used.
+    data = metrics['metrics']
+    delivery = metrics.get("delivery_against_requirements")
+    blocks = ["### Delivery Against Requirements\n\n" + (
+        render_value_table(delivery) if delivery else "Not reported in the source metrics table."
+    )]
+    for metric in EXPECTED_METRICS[:4]:
+        for sub in ['ATLS', 'BTLS']:
+            blocks.append(f"### {metric} ({sub})\n\n{render_value_table(data[metric][sub])}")
+    uat = data["Customer Specific Testing (UAT)"]
+    blocks.append("### Customer Specific Testing (UAT)\n\n" + "\n\n".join(
+        f"#### {client}\n\n{render_uat_table(uat[client])}" for client in UAT_CLIENTS
+    ))
+    blocks.append("### Load/Performance\n\n" + "\n\n".join(
+        f"#### {sub}\n\n{render_value_table(data['Load/Performance'][sub])}" for sub in ['ATLS', 'BTLS']
+    ))
+    for metric in EXPECTED_METRICS[5:10]:
+        title = f"{metric} (ATLS)" if metric == "Defect Closure Rate" else metric
+        blocks.append(f"### {title}\n\n{render_value_table(data[metric])}")
+    return "\n\n".join(blocks)
+
 def enhance_report_markdown(md_text):
     # Remove markdown code fences
     cleaned = re.sub(r'^```markdown\n|\n```$', '', md_text, flags=re.MULTILINE)
@@ -1070,237 +2661,385 @@ def get_base64_image(image_path: str) -> str:
         logger.error(f"Error reading image {image_path}: {str(e)}")
         return ""
 
-def run_fallback_visualization(metrics: Dict[str, Any]):
+def chart_filename(metric: str) -> str:
+    if metric in EXPECTED_METRICS[:5]:
+        return f'{metric.replace("/", "_")}_atls_btls.png'
+    if metric == 'Pass/Fail':
+        return 'pass_fail.png'
+    return f'{metric.replace("/", "_")}.png'
+
+def chart_series(items: Any) -> Tuple[List[str], List[float]]:
+    if not isinstance(items, list):
+        return [], []
+    valid = [item for item in items if isinstance(item, dict) and 'version' in item and 'value' in item]
+    return [item['version'] for item in valid], [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in valid]
+
+def new_chart(title: str, ylabel: str = 'Value'):
+    # Figures are built with the object API rather than pyplot, so no global
+    # pyplot state is touched and charts can render concurrently.
+    fig = Figure(figsize=CHART_FIGSIZE, dpi=CHART_DPI)
+    ax = fig.add_subplot()
+    ax.set_title(title)
+    ax.set_xlabel('Release')
+    ax.set_ylabel(ylabel)
+    return fig, ax
+
+def placeholder_chart(title: str, message: str):
+    fig = Figure(figsize=CHART_FIGSIZE, dpi=CHART_DPI)
+    ax = fig.add_subplot()
+    ax.text(0.5, 0.5, message, ha='center', va='center')
+    ax.set_title(title)
+    return fig
+
+def grouped_bar_chart(title: str, versions: List[str], series: List[Tuple[str, List[float], str]], ylabel: str = 'Value'):
+    fig, ax = new_chart(title, ylabel)
+    x = np.arange(len(versions))
+    width = 0.7 / len(series)
+    for i, (label, values, color) in enumerate(series):
+        ax.bar(x + (i - (len(series) - 1) / 2) * width, values, width, label=label, color=color)
+    ax.set_xticks(x, versions)
+    ax.legend()
+    return fig
+
+def line_chart(title: str, versions: List[str], values: List[float], color: str):
+    fig, ax = new_chart(title)
+    ax.plot(versions, values, marker='o', color=color)
+    return fig
+
+def bar_chart(title: str, versions: List[str], values: List[float], color: str):
+    fig, ax = new_chart(title)
+    ax.bar(versions, values, color=color)
+    return fig
+
+def build_chart(metric: str, data: Any):
+    if metric in EXPECTED_METRICS[:5]:
+        if not isinstance(data, dict) or 'ATLS' not in data or 'BTLS' not in data:
+            return placeholder_chart(metric, f"No data for {metric}")
+        versions, atls_values = chart_series(data.get('ATLS', []))
+        _, btls_values = chart_series(data.get('BTLS', []))
+        if not versions or len(btls_values) != len(versions):
+            return placeholder_chart(metric, f"Incomplete data for {metric}")
+        return grouped_bar_chart(metric, versions, [('ATLS', atls_values, 'blue'), ('BTLS', btls_values, 'orange')])
+    if metric == 'Pass/Fail':
+        if not isinstance(data, dict):
+            return placeholder_chart("Pass/Fail Metrics", "No data for Pass/Fail")
+        versions, pass_values = chart_series(data.get('Pass', []))
+        _, fail_values = chart_series(data.get('Fail', []))
+        if not versions or len(fail_values) != len(versions):
+            return placeholder_chart("Pass/Fail Metrics", "Incomplete data for Pass/Fail")
+        return grouped_bar_chart('Pass/Fail Metrics', versions, [('Pass', pass_values, 'green'), ('Fail', fail_values, 'red')], ylabel='Count')
+    if not isinstance(data, list) or not data:
+        return placeholder_chart(metric, f"No data for {metric}")
+    versions, values = chart_series(data)
+    if not versions:
+        return placeholder_chart(metric, f"Incomplete data for {metric}")
+    if metric in EXPECTED_METRICS[5:8]:
+        return line_chart(metric, versions, values, 'green')
+    return bar_chart(metric, versions, values, 'purple')
+
+def render_charts(metrics: Dict[str, Any], output_dir: str = "visualizations", metric_names: Union[List[str], None] = None,
+                  on_chart=None) -> Dict[str, str]:
+    # Built-in chart engine: grouped ATLS/BTLS bars, coverage lines, bars for
+    # the other metrics and Pass/Fail bars when present. Writes each PNG to
+    # output_dir and returns {filename: base64 PNG}; on_chart(filename, png)
+    # is called as each one is written.
+    if not metrics or 'metrics' not in metrics or not isinstance(metrics['metrics'], dict):
+        logger.error(f"Invalid metrics data: {metrics}")
+        raise ValueError("Metrics data is empty or invalid")
+
+    chart_metrics = EXPECTED_METRICS[:10] + (['Pass/Fail'] if 'Pass/Fail' in metrics['metrics'] else [])
+    if metric_names:
+        chart_metrics = [metric for metric in chart_metrics if metric in metric_names]
+
+    os.makedirs(output_dir, exist_ok=True)
+    charts = {}
+    for metric in chart_metrics:
+        filename = chart_filename(metric)
+        try:
+            fig = build_chart(metric, metrics['metrics'].get(metric))
+        except Exception as e:
+            logger.error(f"Failed to generate chart for {metric}: {str(e)}")
+            fig = placeholder_chart(metric, f"Error generating {metric}")
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        png = buffer.getvalue()
+        with open(os.path.join(output_dir, filename), 'wb') as f:
+            f.write(png)
+        charts[filename] = base64.b64encode(png).decode('utf-8')
+        logger.info(f"Generated chart for {metric}: {filename}")
+        if on_chart:
+            on_chart(filename, charts[filename])
+    logger.info(f"Rendered {len(charts)} charts")
+    return charts
+
+def run_fallback_visualization(metrics: Dict[str, Any], output_dir: str = "visualizations", on_chart=None):
     with shared_state.viz_lock:
         try:
-            os.makedirs("visualizations", exist_ok=True)
-            logging.basicConfig(level=logging.INFO, filename='visualization.log')
-            logger = logging.getLogger(__name__)
             logger.info("Starting fallback visualization")
-
-            if not metrics or 'metrics' not in metrics or not isinstance(metrics['metrics'], dict):
-                logger.error(f"Invalid metrics data: {metrics}")
-                raise ValueError("Metrics data is empty or invalid")
-
-            atls_btls_metrics = EXPECTED_METRICS[:5]
-            coverage_metrics = EXPECTED_METRICS[5:8]
-            other_metrics = EXPECTED_METRICS[8:10]
-
-            generated_files = []
-            for metric in atls_btls_metrics:
-                try:
-                    data = metrics['metrics'].get(metric, {})
-                    if not isinstance(data, dict) or 'ATLS' not in data or 'BTLS' not in data:
-                        logger.warning(f"Creating placeholder for {metric}: invalid or missing ATLS/BTLS data")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"No data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}_atls_btls.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    atls_data = data.get('ATLS', [])
-                    btls_data = data.get('BTLS', [])
-                    versions = [item['version'] for item in atls_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    atls_values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in atls_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    btls_values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in btls_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    if not versions or len(atls_values) != len(versions) or len(btls_values) != len(versions):
-                        logger.warning(f"Creating placeholder for {metric}: inconsistent data lengths")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"Incomplete data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}_atls_btls.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    x = np.arange(len(versions))
-                    width = 0.35
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.bar(x - width/2, atls_values, width, label='ATLS', color='blue')
-                    plt.bar(x + width/2, btls_values, width, label='BTLS', color='orange')
-                    plt.xlabel('Release')
-                    plt.ylabel('Value')
-                    plt.title(metric)
-                    plt.xticks(x, versions)
-                    plt.legend()
-                    filename = f'visualizations/{metric.replace("/", "_")}_atls_btls.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated grouped bar chart for {metric}: {filename}")
-                except Exception as e:
-                    logger.error(f"Failed to generate chart for {metric}: {str(e)}")
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.text(0.5, 0.5, f"Error generating {metric}", ha='center', va='center')
-                    plt.title(metric)
-                    filename = f'visualizations/{metric.replace("/", "_")}_atls_btls.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated error placeholder chart for {metric}: {filename}")
-
-            for metric in coverage_metrics:
-                try:
-                    data = metrics['metrics'].get(metric, [])
-                    if not isinstance(data, list) or not data:
-                        logger.warning(f"Creating placeholder for {metric}: invalid data format")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"No data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    versions = [item['version'] for item in data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    if not versions or len(values) != len(versions):
-                        logger.warning(f"Creating placeholder for {metric}: inconsistent data lengths")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"Incomplete data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.plot(versions, values, marker='o', color='green')
-                    plt.xlabel('Release')
-                    plt.ylabel('Value')
-                    plt.title(metric)
-                    filename = f'visualizations/{metric.replace("/", "_")}.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated line chart for {metric}: {filename}")
-                except Exception as e:
-                    logger.error(f"Failed to generate chart for {metric}: {str(e)}")
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.text(0.5, 0.5, f"Error generating {metric}", ha='center', va='center')
-                    plt.title(metric)
-                    filename = f'visualizations/{metric.replace("/", "_")}.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated error placeholder chart for {metric}: {filename}")
-
-            for metric in other_metrics:
-                try:
-                    data = metrics['metrics'].get(metric, [])
-                    if not isinstance(data, list) or not data:
-                        logger.warning(f"Creating placeholder for {metric}: invalid data format")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"No data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    versions = [item['version'] for item in data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                    if not versions or len(values) != len(versions):
-                        logger.warning(f"Creating placeholder for {metric}: inconsistent data lengths")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, f"Incomplete data for {metric}", ha='center', va='center')
-                        plt.title(metric)
-                        filename = f'visualizations/{metric.replace("/", "_")}.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for {metric}: {filename}")
-                        continue
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.bar(versions, values, color='purple')
-                    plt.xlabel('Release')
-                    plt.ylabel('Value')
-                    plt.title(metric)
-                    filename = f'visualizations/{metric.replace("/", "_")}.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated bar chart for {metric}: {filename}")
-                except Exception as e:
-                    logger.error(f"Failed to generate chart for {metric}: {str(e)}")
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.text(0.5, 0.5, f"Error generating {metric}", ha='center', va='center')
-                    plt.title(metric)
-                    filename = f'visualizations/{metric.replace("/", "_")}.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated error placeholder chart for {metric}: {filename}")
-
-            if 'Pass/Fail' in metrics['metrics']:
-                try:
-                    data = metrics['metrics'].get('Pass/Fail', {})
-                    if not isinstance(data, dict):
-                        logger.warning(f"Creating placeholder for Pass/Fail: invalid data format")
-                        plt.figure(figsize=(8,5), dpi=120)
-                        plt.text(0.5, 0.5, "No data for Pass/Fail", ha='center', va='center')
-                        plt.title("Pass/Fail Metrics")
-                        filename = 'visualizations/pass_fail.png'
-                        plt.savefig(filename)
-                        plt.close()
-                        generated_files.append(filename)
-                        logger.info(f"Generated placeholder chart for Pass/Fail: {filename}")
-                    else:
-                        pass_data = data.get('Pass', [])
-                        fail_data = data.get('Fail', [])
-                        versions = [item['version'] for item in pass_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                        pass_values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in pass_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                        fail_values = [float(item['value']) if isinstance(item['value'], (int, float)) else 0 for item in fail_data if isinstance(item, dict) and 'version' in item and 'value' in item]
-                        if not versions or len(pass_values) != len(versions) or len(fail_values) != len(versions):
-                            logger.warning(f"Creating placeholder for Pass/Fail: inconsistent data lengths")
-                            plt.figure(figsize=(8,5), dpi=120)
-                            plt.text(0.5, 0.5, "Incomplete data for Pass/Fail", ha='center', va='center')
-                            plt.title("Pass/Fail Metrics")
-                            filename = 'visualizations/pass_fail.png'
-                            plt.savefig(filename)
-                            plt.close()
-                            generated_files.append(filename)
-                            logger.info(f"Generated placeholder chart for Pass/Fail: {filename}")
-                        else:
-                            x = np.arange(len(versions))
-                            width = 0.35
-                            plt.figure(figsize=(8,5), dpi=120)
-                            plt.bar(x - width/2, pass_values, width, label='Pass', color='green')
-                            plt.bar(x + width/2, fail_values, width, label='Fail', color='red')
-                            plt.xlabel('Release')
-                            plt.ylabel('Count')
-                            plt.title('Pass/Fail Metrics')
-                            plt.xticks(x, versions)
-                            plt.legend()
-                            filename = 'visualizations/pass_fail.png'
-                            plt.savefig(filename)
-                            plt.close()
-                            generated_files.append(filename)
-                            logger.info(f"Generated grouped bar chart for Pass/Fail: {filename}")
-                except Exception as e:
-                    logger.error(f"Failed to generate chart for Pass/Fail: {str(e)}")
-                    plt.figure(figsize=(8,5), dpi=120)
-                    plt.text(0.5, 0.5, "Error generating Pass/Fail", ha='center', va='center')
-                    plt.title("Pass/Fail Metrics")
-                    filename = 'visualizations/pass_fail.png'
-                    plt.savefig(filename)
-                    plt.close()
-                    generated_files.append(filename)
-                    logger.info(f"Generated error placeholder chart for Pass/Fail: {filename}")
-
-            logger.info(f"Completed fallback visualization, generated {len(generated_files)} files")
+            render_charts(metrics, output_dir, on_chart=on_chart)
         except Exception as e:
             logger.error(f"Fallback visualization failed: {str(e)}")
             raise
-        finally:
-            plt.close('all')
+
+def extract_pdf_worker(pdf_path: str, content_hash: str) -> Dict[str, Any]:
+    # Runs inside the extraction pool. The result is written to the
+    # extraction cache here, so the parent process doesn't store it again.
+    result = ingest_pdf(pdf_path)
+    store_cached_extraction(content_hash, result)
+    return result
+
+extraction_executor = None
+extraction_executor_lock = Lock()
+
+def get_extraction_executor():
+    global extraction_executor
+    with extraction_executor_lock:
+        if extraction_executor is None:
+            if EXTRACTION_BACKEND == "thread":
+                extraction_executor = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS)
+            else:
+                # Spawned, not forked: a fork of the threaded server would
+                # inherit held locks and cache.db connections (and fork is
+                # not available on Windows)
+                extraction_executor = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS,
+                                                          mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"Started {EXTRACTION_BACKEND} extraction pool with {EXTRACTION_WORKERS} workers")
+        return extraction_executor
+
+def reset_extraction_executor(broken):
+    # A worker that died (OOM, crash in PyPDF2) leaves the process pool
+    # unusable; the next get_extraction_executor() starts a new one
+    global extraction_executor
+    with extraction_executor_lock:
+        if extraction_executor is broken:
+            extraction_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def run_extraction_pool(pending: Dict[str, str], results: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    # Parses the pending PDFs into results; returns the ones lost to a broken pool
+    executor = get_extraction_executor()
+    futures = {}
+    lost = {}
+    for pdf, content_hash in pending.items():
+        try:
+            futures[executor.submit(extract_pdf_worker, pdf, content_hash)] = pdf
+        except BrokenProcessPool:
+            lost[pdf] = content_hash
+
+    for future in as_completed(futures):
+        pdf = futures[future]
+        try:
+            results[pdf] = future.result()
+        except BrokenProcessPool:
+            lost[pdf] = pending[pdf]
+        except Exception as e:
+            logger.error(f"Failed to process {pdf}: {str(e)}")
+    if lost:
+        reset_extraction_executor(executor)
+    return lost
+
+def extract_pdf_folder(pdf_files: List[str]) -> Tuple[List[Tuple[str, str]], List[Dict]]:
+    # Reuse per-PDF extractions keyed by content hash; only new or changed
+    # files go through PyPDF2.
+    results = {}
+    pending = {}
+    content_hashes = fingerprint_pdf_files(pdf_files)
+    for pdf in pdf_files:
+        content_hash = content_hashes[pdf]
+        cached = get_cached_extraction(content_hash, os.path.basename(pdf))
+        if cached:
+            results[pdf] = cached
+        else:
+            pending[pdf] = content_hash
+    logger.info(f"Extraction cache: {len(results)} hit(s), {len(pending)} PDF(s) to parse")
+
+    # Parallel PDF processing, one parse per PDF. PDFs lost to a broken
+    # pool are resubmitted once to a fresh one.
+    if pending:
+        lost = run_extraction_pool(pending, results)
+        if lost:
+            logger.warning(f"Extraction pool broke, resubmitting {len(lost)} PDF(s) to a new pool")
+            lost = run_extraction_pool(lost, results)
+        for pdf in lost:
+            logger.error(f"Failed to process {pdf}: extraction pool broke twice")
+
+    extracted_texts = []
+    all_hyperlinks = []
+    for pdf in pdf_files:
+        result = results.get(pdf)
+        if not result:
+            continue
+        all_hyperlinks.extend(result["hyperlinks"])
+        if result["table_text"]:
+            extracted_texts.append((result["source_file"], result["table_text"]))
+
+    return extracted_texts, all_hyperlinks
+
+def read_chart_folder(viz_folder: str, on_chart=None) -> List[str]:
+    viz_base64 = []
+    viz_files = sorted([f for f in os.listdir(viz_folder) if f.endswith('.png')])
+    for img in viz_files:
+        base64_str = get_base64_image(os.path.join(viz_folder, img))
+        if base64_str:
+            viz_base64.append(base64_str)
+            if on_chart:
+                on_chart(img, base64_str)
+    return viz_base64
+
+def render_chart_stage(ctx: PipelineContext, viz_script: Union[str, None] = None) -> List[str]:
+    # Writes the charts into the run's output directory (with the LLM-written
+    # script when given, else render_charts) and returns them base64-encoded.
+    # Built-in charts are published as they render and used as returned;
+    # only script output is read back from the directory.
+    metrics = ctx.metrics
+    viz_folder = ctx.output_dir
+    script_failed = False
+    published = set()
+    charts = None
+
+    def publish_chart(filename: str, png: str):
+        if filename not in published:
+            published.add(filename)
+            ctx.progress.publish("chart", {"name": filename, "image": png})
+
+    if os.path.exists(viz_folder):
+        shutil.rmtree(viz_folder)
+    os.makedirs(viz_folder, exist_ok=True)
+
+    if viz_script is None:
+        charts = render_charts(metrics, viz_folder, on_chart=publish_chart)
+    else:
+        # Scripts drive pyplot's global state, so only one runs at a time
+        with shared_state.viz_lock:
+            script_path = ctx.script_path
+            try:
+                with open(script_path, "w", encoding="utf-8") as f:
+                    f.write(viz_script)
+                logger.info(f"Visualization script written to {script_path}")
+                logger.debug(f"Visualization script content:\n{viz_script}")
+                runpy.run_path(script_path, init_globals={'metrics': metrics, 'output_dir': viz_folder})
+                logger.info("Visualization script executed successfully")
+            except Exception as e:
+                logger.error(f"Visualization script failed: {str(e)}")
+                script_failed = True
+    if script_failed:
+        logger.info("Running fallback visualization")
+        run_fallback_visualization(metrics, viz_folder, publish_chart)
+
+    expected_count = 10 + (1 if 'Pass/Fail' in metrics.get('metrics', {}) else 0)
+    min_visualizations = 5
+    if charts is not None:
+        viz_base64 = [charts[filename] for filename in sorted(charts)]
+    else:
+        viz_base64 = read_chart_folder(viz_folder, publish_chart)
+    logger.info(f"Generated {len(viz_base64)} visualizations, expected {expected_count}, minimum required {min_visualizations}")
+    if len(viz_base64) < min_visualizations:
+        logger.warning("Insufficient visualizations, running fallback")
+        run_fallback_visualization(metrics, viz_folder, publish_chart)
+        viz_base64 = read_chart_folder(viz_folder)
+        if len(viz_base64) < min_visualizations:
+            logger.error(f"Still too few visualizations: {len(viz_base64)}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to generate minimum required visualizations: got {len(viz_base64)}, need at least {min_visualizations}"
+            )
+    return viz_base64
+
+async def run_chart_stage(ctx: PipelineContext, versions: List[str]) -> List[str]:
+    ctx.progress.update("viz", "running")
+    viz_script = None
+    if USE_LLM_VISUALIZER:
+        viz_crew = setup_viz_crew(ctx.metrics, versions, ctx, llm)
+        logger.info("Starting viz_crew")
+        await viz_crew.kickoff_async()
+        logger.info("Viz_crew completed")
+
+        # Validate viz_crew output
+        if not hasattr(viz_crew.tasks[0], 'output') or not hasattr(viz_crew.tasks[0].output, 'raw'):
+            logger.error(f"Invalid output for viz_crew task {viz_crew.tasks[0]}")
+            raise ValueError("Visualization crew did not produce a valid output")
+        raw_script = viz_crew.tasks[0].output.raw
+        logger.info(f"Viz_crew output: {raw_script[:100]}...")
+        viz_script = re.sub(r'```python|```$', '', raw_script, flags=re.MULTILINE).strip()
+    viz_base64 = await asyncio.to_thread(render_chart_stage, ctx, viz_script)
+    ctx.progress.update("viz", "done")
+    return viz_base64
+
+async def generate_report(ctx: PipelineContext, versions: List[str], metrics_summary: str, variant: str = "") -> str:
+    # Report stage: writes the narrative sections concurrently and assembles
+    # them around the rendered Metrics Summary.
+    llm_cache_variant.set(variant)
+    report_crews = setup_report_crews(ctx.metrics, versions, ctx, llm)
+    ctx.progress.publish("section", {"variant": variant, "section": "Metrics Summary",
+                                     "markdown": section_body("Metrics Summary", metrics_summary)})
+
+    async def write_section(section: str, crew: Crew) -> str:
+        await crew.kickoff_async()
+        # Validate report section output
+        task = crew.tasks[0]
+        if not hasattr(task, 'output') or not hasattr(task.output, 'raw'):
+            logger.error(f"Invalid output for report section {section}: {task}")
+            raise ValueError(f"Report crew for {section} did not produce a valid output")
+        logger.info(f"Report section {section} output: {task.output.raw[:100]}...")
+        body = enhance_report_markdown(task.output.raw)
+        ctx.progress.publish("section", {"variant": variant, "section": section, "markdown": section_body(section, body)})
+        return body
+
+    logger.info("Starting report section crews" + (f" ({variant})" if variant else ""))
+    bodies = await asyncio.gather(*(write_section(section, crew) for section, crew in report_crews.items()))
+    logger.info("Report section crews completed" + (f" ({variant})" if variant else ""))
+
+    sections = dict(zip(report_crews, bodies))
+    sections["Metrics Summary"] = metrics_summary
+    enhanced_report = assemble_report(sections)
+    if not validate_report(enhanced_report):
+        logger.error("Report missing required sections")
+        raise HTTPException(status_code=500, detail="Generated report is incomplete")
+    return enhanced_report
+
+async def score_report_candidate(ctx: PipelineContext, full_source_text: str, versions: List[str],
+                                 metrics_summary: str, variant: str) -> Tuple[int, str, str]:
+    enhanced_report = await generate_report(ctx, versions, metrics_summary, variant)
+    score, evaluation = await evaluate_with_llm_judge(full_source_text, enhanced_report, ctx.budget)
+    logger.info(f"Report candidate {variant or 'candidate-0'}: Evaluation score = {score}")
+    return score, evaluation, enhanced_report
+
+async def best_of_n_reports(ctx: PipelineContext, full_source_text: str, versions: List[str],
+                            metrics_summary: str, n: int) -> Tuple[int, str, str]:
+    # Generates and judges n candidates concurrently. Returns the first one
+    # that clears the threshold, otherwise the highest-scoring one. Losing
+    # candidates are cancelled and awaited, so they publish nothing more,
+    # but section crews already running in worker threads are not
+    # interrupted: their in-flight LLM calls finish (and are cached) unused.
+    logger.info(f"Generating {n} report candidates concurrently")
+    candidates = [
+        asyncio.create_task(score_report_candidate(
+            ctx, full_source_text, versions, metrics_summary, f"candidate-{i}" if i else ""
+        ))
+        for i in range(n)
+    ]
+    best = None
+    try:
+        for next_candidate in asyncio.as_completed(candidates):
+            try:
+                result = await next_candidate
+            except Exception as e:
+                logger.error(f"Report candidate failed: {str(e)}")
+                continue
+            if best is None or result[0] > best[0]:
+                best = result
+            if result[0] > REPORT_SCORE_THRESHOLD:
+                logger.info(f"Score {result[0]} exceeds threshold of {REPORT_SCORE_THRESHOLD}, skipping remaining candidates")
+                break
+    finally:
+        for candidate in candidates:
+            candidate.cancel()
+        await asyncio.gather(*candidates, return_exceptions=True)
+    if best is None:
+        raise ValueError(f"All {n} report candidates failed")
+    if best[0] <= REPORT_SCORE_THRESHOLD:
+        logger.warning(f"No candidate exceeded {REPORT_SCORE_THRESHOLD}, proceeding with best score {best[0]}")
+    return best
 
 # async def run_full_analysis(request: FolderPathRequest) -> AnalysisResponse:
 #     folder_path = convert_windows_path(request.folder_path)
@@ -1460,8 +3199,7 @@ def run_fallback_visualization(metrics: Dict[str, Any]):
 #         evaluation={"score": score, "text": evaluation},
 #         hyperlinks=all_hyperlinks
 #     )
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-async def run_full_analysis(request: FolderPathRequest) -> AnalysisResponse:
+async def run_full_analysis(request: FolderPathRequest, progress: Union[StageProgress, None] = None) -> AnalysisResponse:
     folder_path = convert_windows_path(request.folder_path)
     folder_path = os.path.normpath(folder_path)
    
@@ -1470,65 +3208,48 @@ async def run_full_analysis(request: FolderPathRequest) -> AnalysisResponse:
    
     pdf_files = get_pdf_files_from_folder(folder_path)
     logger.info(f"Processing {len(pdf_files)} PDF files")
+    # Inherited by the stage tasks and crew threads started below
+    llm_cache_bypass.set(request.clear_cache)
 
-    versions = []
-    for pdf_path in pdf_files:
-        match = re.search(r'(\d+\.\d+)(?:\s|\.)', os.path.basename(pdf_path))
-        if match:
-            versions.append(match.group(1))
-    versions = sorted(set(versions))
+    versions = sorted({extract_version(os.path.basename(pdf_path)) for pdf_path in pdf_files} - {None})
     if len(versions) < 2:
         raise HTTPException(status_code=400, detail="At least two versions are required for analysis")
 
-    # Parallel PDF processing
-    extracted_texts = []
-    all_hyperlinks = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        text_futures = {executor.submit(extract_text_from_pdf, pdf): pdf for pdf in pdf_files}
-        hyperlink_futures = {executor.submit(extract_hyperlinks_from_pdf, pdf): pdf for pdf in pdf_files}
-       
-        for future in as_completed(text_futures):
-            pdf = text_futures[future]
-            try:
-                text = locate_table(future.result(), START_HEADER_PATTERN, END_HEADER_PATTERN)
-                extracted_texts.append((os.path.basename(pdf), text))
-            except Exception as e:
-                logger.error(f"Failed to process text from {pdf}: {str(e)}")
-                continue
-       
-        for future in as_completed(hyperlink_futures):
-            pdf = hyperlink_futures[future]
-            try:
-                all_hyperlinks.extend(future.result())
-            except Exception as e:
-                logger.error(f"Failed to process hyperlinks from {pdf}: {str(e)}")
-                continue
+    ctx = PipelineContext(folder_path, progress)
+    ctx.progress.update("extract", "running")
+    # Parsing blocks on the extraction pool, so it runs off the event loop
+    extracted_texts, all_hyperlinks = await asyncio.to_thread(extract_pdf_folder, pdf_files)
 
     if not extracted_texts:
         raise HTTPException(status_code=400, detail="No valid text extracted from PDFs")
 
-    full_source_text = "\n".join(
-        f"File: {name}\n{text}" for name, text in extracted_texts
-    )
-
-    max_attempts = 3
-    attempt = 1
-    score = 0
-    while attempt <= max_attempts:
-        logger.info(f"Starting report generation attempt {attempt}/{max_attempts}")
-        
-        # Reset shared_state.metrics to ensure fresh data
-        with shared_state.lock:
-            shared_state.metrics = None
-
-        # Get sub-crews
-        data_crew, report_crew, viz_crew = setup_crew(full_source_text, versions, llm)
-   
-        # Run data_crew
+    # Compact encoding of the tables shared by the structurer and judge prompts.
+    # Releases whose files did not fit the token cap are left out of the whole
+    # analysis, so the metrics, report and judge all cover the same releases.
+    try:
+        full_source_text, versions = encode_source_text(extracted_texts, versions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    ctx.progress.update("extract", "done")
+
+    # Structure the table by rules when possible; the LLM structurer only
+    # runs when the parser cannot cover every metric and version.
+    ctx.progress.update("data", "running")
+    parsed_metrics = parse_metrics_table(extracted_texts, versions)
+    if parsed_metrics:
+        logger.info("Metrics table structured by rule-based parser, skipping LLM structurer")
+
+    # Metrics stage: runs once per analysis. Only the report stage below is
+    # retried when the judge rejects a report.
+    # Building the agents takes seconds, so it runs off the event loop too
+    data_crew = await asyncio.to_thread(setup_data_crew, full_source_text, versions, ctx, llm, parsed_metrics)
+
+    # Run data_crew (absent when the table parser already structured the metrics)
+    if data_crew:
         logger.info("Starting data_crew")
         await data_crew.kickoff_async()
         logger.info("Data_crew completed")
-   
+
         # Validate task outputs
         for i, task in enumerate(data_crew.tasks):
             if not hasattr(task, 'output') or not hasattr(task.output, 'raw'):
@@ -1536,140 +3257,375 @@ async def run_full_analysis(request: FolderPathRequest) -> AnalysisResponse:
                 raise ValueError(f"Data crew task {i} did not produce a valid output")
             logger.info(f"Data_crew task {i} output: {task.output.raw[:200]}...")
 
-        # Validate metrics
-        if not shared_state.metrics or not isinstance(shared_state.metrics, dict):
-            logger.error(f"Invalid metrics in shared_state: type={type(shared_state.metrics)}, value={shared_state.metrics}")
-            raise HTTPException(status_code=500, detail="Failed to generate valid metrics data")
-        logger.info(f"Metrics after data_crew: {json.dumps(shared_state.metrics, indent=2)[:200]}...")
-
-        # Run report_crew and viz_crew in parallel
-        logger.info("Starting report_crew and viz_crew")
-        await asyncio.gather(
-            report_crew.kickoff_async(),
-            viz_crew.kickoff_async()
+    # Validate metrics
+    if not ctx.metrics or not isinstance(ctx.metrics, dict):
+        logger.error(f"Invalid metrics for run {ctx.run_id}: type={type(ctx.metrics)}, value={ctx.metrics}")
+        raise HTTPException(status_code=500, detail="Failed to generate valid metrics data")
+    logger.info(f"Metrics after data_crew: {json.dumps(ctx.metrics, indent=2)[:200]}...")
+
+    metrics = ctx.metrics
+    # Not a charted metric, so it sits beside metrics['metrics'] rather than in it
+    metrics["delivery_against_requirements"] = parse_delivery_against_requirements(extracted_texts, versions)
+    ctx.progress.publish("metrics", metrics)
+    ctx.progress.update("data", "done")
+
+    # Chart stage: runs once, alongside the first report attempt
+    chart_stage = asyncio.create_task(run_chart_stage(ctx, versions))
+    metrics_summary = render_metrics_summary(metrics)
+
+    try:
+        if REPORT_CANDIDATES > 1:
+            ctx.progress.update("report", "running")
+            ctx.progress.update("judge", "running")
+            score, evaluation, enhanced_report = await best_of_n_reports(
+                ctx, full_source_text, versions, metrics_summary, REPORT_CANDIDATES
+            )
+            ctx.progress.update("report", "done")
+            ctx.progress.update("judge", "done")
+        else:
+            # Only the report stage is retried, both after a low score and
+            # after a failed attempt; HTTPExceptions are never retried
+            max_attempts = 3
+            enhanced_report = None
+            for attempt in range(1, max_attempts + 1):
+                logger.info(f"Starting report generation attempt {attempt}/{max_attempts}")
+                ctx.progress.update("report", "running")
+                try:
+                    report = await generate_report(
+                        ctx, versions, metrics_summary, f"attempt-{attempt}" if attempt > 1 else ""
+                    )
+                except Exception as e:
+                    if isinstance(e, HTTPException) or (attempt == max_attempts and enhanced_report is None):
+                        raise
+                    logger.warning(f"Report attempt {attempt}/{max_attempts} failed: {str(e)}")
+                    continue
+                enhanced_report = report
+                ctx.progress.update("report", "done")
+                ctx.progress.update("judge", "running")
+                score, evaluation = await evaluate_with_llm_judge(full_source_text, enhanced_report, ctx.budget)
+                ctx.progress.update("judge", "done")
+                logger.info(f"Attempt {attempt}: Evaluation score = {score}")
+
+                if score > REPORT_SCORE_THRESHOLD:
+                    logger.info(f"Score {score} exceeds threshold of {REPORT_SCORE_THRESHOLD}, proceeding with response")
+                    break
+                if attempt < max_attempts:
+                    logger.warning(f"Score {score} <= {REPORT_SCORE_THRESHOLD}, regenerating report (attempt {attempt}/{max_attempts})")
+                else:
+                    logger.warning(f"Max attempts ({max_attempts}) reached with score {score}, proceeding with final response")
+
+        ctx.progress.publish("evaluation", {"score": score, "text": evaluation, "report": enhanced_report})
+        viz_base64 = await chart_stage
+    except BaseException:
+        chart_stage.cancel()
+        raise
+    finally:
+        # The charts are returned base64-encoded; the run's PNGs aren't kept
+        ctx.cleanup()
+
+    budget_report = ctx.budget.report()
+    logger.info(f"Prompt budget: {budget_report['total_tokens']} tokens ({budget_report['counter']}): "
+                + ", ".join(f"{name}={p['total']}x{p['calls']}" for name, p in budget_report['prompts'].items()))
+    with prompt_budgets_lock:
+        prompt_budgets[hash_string(folder_path)] = {**budget_report, "folder_path": folder_path}
+        prompt_budgets.move_to_end(hash_string(folder_path))
+        while len(prompt_budgets) > PROMPT_BUDGET_HISTORY:
+            prompt_budgets.popitem(last=False)
+
+    return AnalysisResponse(
+        metrics=metrics,
+        visualizations=viz_base64,
+        report=enhanced_report,
+        evaluation={"score": score, "text": evaluation},
+        hyperlinks=all_hyperlinks
+    )
+
+inflight_analyses: Dict[Tuple[str, str], Tuple[asyncio.Task, StageProgress]] = {}
+
+async def keep_analysis_lease(folder_path_hash: str, pdfs_hash: str, owner: str):
+    while True:
+        await asyncio.sleep(ANALYSIS_LEASE_TTL_SECONDS / 3)
+        await asyncio.to_thread(renew_analysis_lease, folder_path_hash, pdfs_hash, owner)
+
+async def run_leased_analysis(request: FolderPathRequest, folder_path_hash: str, pdfs_hash: str,
+                              progress: StageProgress) -> AnalysisResponse:
+    # Runs the analysis once across worker processes sharing cache.db: the
+    # lease holder runs it and caches the report, the others wait for it.
+    owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    waiting_since = int(time.time())
+    if not acquire_analysis_lease(folder_path_hash, pdfs_hash, owner):
+        logger.info(f"Analysis for folder_path_hash: {folder_path_hash} running in another worker, waiting")
+        while not acquire_analysis_lease(folder_path_hash, pdfs_hash, owner):
+            await asyncio.sleep(ANALYSIS_LEASE_POLL_SECONDS)
+            cached_response = get_cached_report(folder_path_hash, pdfs_hash, waiting_since)
+            if cached_response:
+                logger.info(f"Using report cached by another worker for folder_path_hash: {folder_path_hash}")
+                return cached_response
+
+    heartbeat = asyncio.create_task(keep_analysis_lease(folder_path_hash, pdfs_hash, owner))
+    try:
+        # The previous holder may have cached its report between our last
+        # poll and taking over the lease
+        cached_response = get_cached_report(folder_path_hash, pdfs_hash, waiting_since)
+        if cached_response:
+            logger.info(f"Using report cached by another worker for folder_path_hash: {folder_path_hash}")
+            return cached_response
+        logger.info(f"Running full analysis for folder_path_hash: {folder_path_hash}")
+        response = await run_full_analysis(request, progress)
+        store_cached_report(folder_path_hash, pdfs_hash, response, os.path.normpath(convert_windows_path(request.folder_path)))
+        return response
+    finally:
+        heartbeat.cancel()
+        release_analysis_lease(folder_path_hash, pdfs_hash, owner)
+
+async def run_single_flight(request: FolderPathRequest, folder_path_hash: str, pdfs_hash: str,
+                            listener=None, event_listener=None) -> AnalysisResponse:
+    # Concurrent requests for the same folder and PDFs share one analysis.
+    # It runs as its own task, so a caller disconnecting doesn't cancel it
+    # for the others. listener(stage, state) receives its stage progress,
+    # event_listener(event, data) its partial results.
+    key = (folder_path_hash, pdfs_hash)
+    inflight = inflight_analyses.get(key)
+    if inflight is None:
+        progress = StageProgress()
+        task = asyncio.create_task(run_leased_analysis(request, folder_path_hash, pdfs_hash, progress))
+        inflight_analyses[key] = (task, progress)
+        task.add_done_callback(
+            lambda done: inflight_analyses.pop(key) if inflight_analyses.get(key, (None,))[0] is done else None
         )
-        logger.info("Report_crew and viz_crew completed")
+    else:
+        task, progress = inflight
+        logger.info(f"Joining in-flight analysis for folder_path_hash: {folder_path_hash}")
+    if listener or event_listener:
+        progress.subscribe(listener, event_listener)
+    try:
+        return await asyncio.shield(task)
+    finally:
+        # A caller that stops waiting (e.g. a disconnected SSE client) stops
+        # receiving the shared analysis's progress
+        if listener or event_listener:
+            progress.unsubscribe(listener, event_listener)
+
+async def analyze_folder(request: FolderPathRequest, listener=None, event_listener=None) -> AnalysisResponse:
+    # Cached report for the folder's current PDFs, else a (shared) full analysis
+    if listener:
+        listener("hash", "running")
+    folder_path = convert_windows_path(request.folder_path)
+    folder_path = os.path.normpath(folder_path)
+    folder_path_hash = hash_string(folder_path)
+    pdfs_hash = await asyncio.to_thread(hash_folder_pdfs, folder_path)
+    logger.info(f"Computed hashes - folder_path_hash: {folder_path_hash}, pdfs_hash: {pdfs_hash}")
+    if listener:
+        listener("hash", "done")
+
+    # Skip cache if clear_cache is True
+    if not request.clear_cache:
+        cached_response = get_cached_report(folder_path_hash, pdfs_hash, allow_stale=True)
+        if cached_response:
+            if cached_response.stale:
+                logger.info(f"Serving stale report for folder_path_hash: {folder_path_hash}, refreshing in background")
+                schedule_report_refresh(folder_path, folder_path_hash, pdfs_hash)
+            else:
+                logger.info(f"Cache hit for folder_path_hash: {folder_path_hash}")
+            return cached_response
+    else:
+        logger.info(f"Cache bypassed due to clear_cache=True for folder_path_hash: {folder_path_hash}")
 
-        # Validate report_crew output
-        if not hasattr(report_crew.tasks[-1], 'output') or not hasattr(report_crew.tasks[-1].output, 'raw'):
-            logger.error(f"Invalid output for report_crew task {report_crew.tasks[-1]}")
-            raise ValueError("Report crew did not produce a valid output")
-        logger.info(f"Report_crew output: {report_crew.tasks[-1].output.raw[:100]}...")
+    return await run_single_flight(request, folder_path_hash, pdfs_hash, listener, event_listener)
 
-        # Validate viz_crew output
-        if not hasattr(viz_crew.tasks[0], 'output') or not hasattr(viz_crew.tasks[0].output, 'raw'):
-            logger.error(f"Invalid output for viz_crew task {viz_crew.tasks[0]}")
-            raise ValueError("Visualization crew did not produce a valid output")
-        logger.info(f"Viz_crew output: {viz_crew.tasks[0].output.raw[:100]}...")
+report_refreshes: Dict[str, asyncio.Task] = {}
+
+def record_refresh_failure(folder_path_hash: str):
+    current_time = int(time.time())
+    with cache_db.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE report_cache
+            SET refresh_failures = refresh_failures + 1,
+                refresh_retry_at = ? + MIN(? * (1 << MIN(refresh_failures, 16)), ?)
+            WHERE folder_path_hash = ?
+        ''', (current_time, REFRESH_FAILURE_BACKOFF_SECONDS, REFRESH_FAILURE_BACKOFF_MAX_SECONDS, folder_path_hash))
+
+def refresh_retry_at(folder_path_hash: str) -> Union[int, None]:
+    # When a folder backing off after failed refreshes may be refreshed again
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT refresh_retry_at
+            FROM report_cache
+            WHERE folder_path_hash = ? AND refresh_retry_at > ?
+        ''', (folder_path_hash, int(time.time())))
+        result = cursor.fetchone()
+    return result[0] if result else None
 
-        metrics = shared_state.metrics
+async def refresh_report(folder_path: str, folder_path_hash: str, pdfs_hash: str) -> Union[AnalysisResponse, None]:
+    # None when the folder is backing off after failed refreshes
+    retry_at = await asyncio.to_thread(refresh_retry_at, folder_path_hash)
+    if retry_at is not None:
+        logger.info(f"Skipping refresh for folder_path_hash: {folder_path_hash}, backing off for {retry_at - int(time.time())}s")
+        return None
+    request = FolderPathRequest(folder_path=folder_path, clear_cache=True)
+    try:
+        return await run_single_flight(request, folder_path_hash, pdfs_hash)
+    except Exception:
+        await asyncio.to_thread(record_refresh_failure, folder_path_hash)
+        raise
 
-        # Get report from assemble_report_task
-        enhanced_report = enhance_report_markdown(report_crew.tasks[-1].output.raw)
-        if not validate_report(enhanced_report):
-            logger.error("Report missing required sections")
-            raise HTTPException(status_code=500, detail="Generated report is incomplete")
+def schedule_report_refresh(folder_path: str, folder_path_hash: str, pdfs_hash: str) -> bool:
+    # Recomputes a cached report in the background through the shared
+    # single-flight path, at most one refresh per folder
+    if folder_path_hash in report_refreshes:
+        return False
+    task = asyncio.create_task(refresh_report(folder_path, folder_path_hash, pdfs_hash))
+    report_refreshes[folder_path_hash] = task
+
+    def refresh_done(done: asyncio.Task):
+        report_refreshes.pop(folder_path_hash, None)
+        if done.cancelled():
+            return
+        if done.exception():
+            logger.error(f"Background refresh failed for folder_path_hash: {folder_path_hash}: {str(done.exception())}")
+        elif done.result() is not None:
+            logger.info(f"Background refresh done for folder_path_hash: {folder_path_hash}")
+
+    task.add_done_callback(refresh_done)
+    return True
+
+def get_refresh_ahead_candidates(limit: int) -> List[Tuple[str, str]]:
+    # Popular folders whose report expires within REFRESH_AHEAD_SECONDS (or
+    # already has and is being served stale), most hits first. Folders
+    # backing off after failed refreshes are left out.
+    current_time = int(time.time())
+    with cache_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT folder_path_hash, folder_path
+            FROM report_cache
+            WHERE folder_path IS NOT NULL AND hits >= ? AND created_at < ? AND created_at >= ?
+              AND (refresh_retry_at IS NULL OR refresh_retry_at <= ?)
+            ORDER BY hits DESC
+            LIMIT ?
+        ''', (REFRESH_AHEAD_MIN_HITS, current_time - CACHE_TTL_SECONDS + REFRESH_AHEAD_SECONDS,
+              current_time - CACHE_TTL_SECONDS - CACHE_STALE_SECONDS, current_time, limit))
+        return cursor.fetchall()
+
+def hash_folder_pdfs(folder_path: str) -> str:
+    return hash_pdf_contents(get_pdf_files_from_folder(folder_path))
+
+async def run_refresh_ahead():
+    await asyncio.to_thread(flush_report_cache_touches)
+    slots = REFRESH_MAX_CONCURRENT - len(report_refreshes)
+    if slots <= 0:
+        return
+    candidates = await asyncio.to_thread(get_refresh_ahead_candidates, slots + len(report_refreshes))
+    for folder_path_hash, folder_path in candidates:
+        if slots <= 0:
+            break
+        if folder_path_hash in report_refreshes:
+            continue
+        try:
+            pdfs_hash = await asyncio.to_thread(hash_folder_pdfs, folder_path)
+        except Exception as e:
+            logger.warning(f"Skipping refresh-ahead for {folder_path}: {str(e)}")
+            await asyncio.to_thread(record_refresh_failure, folder_path_hash)
+            continue
+        logger.info(f"Refreshing report ahead of expiry for {folder_path}")
+        schedule_report_refresh(folder_path, folder_path_hash, pdfs_hash)
+        slots -= 1
+
+async def run_refresh_ahead_loop():
+    while True:
+        await asyncio.sleep(REFRESH_AHEAD_INTERVAL_SECONDS)
+        try:
+            await run_refresh_ahead()
+        except Exception as e:
+            logger.error(f"Refresh-ahead failed: {str(e)}")
+
+job_wakeup = asyncio.Event()
+
+async def keep_job_alive(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        await asyncio.to_thread(update_job, job_id, heartbeat_at=time.time())
+
+async def run_job(job_id: str, folder_path: str, clear_cache: bool):
+    stages = {stage: "pending" for stage in PIPELINE_STAGES}
+    loop = asyncio.get_running_loop()
+    stages_changed = asyncio.Event()
+    stages_write_lock = asyncio.Lock()
+
+    def record_stage(stage: str, state: str):
+        # Called from the loop or from worker threads; write_stages stores it
+        stages[stage] = state
+        loop.call_soon_threadsafe(stages_changed.set)
+
+    async def write_stages():
+        # One write at a time, off the loop, always with the latest stages
+        while True:
+            await stages_changed.wait()
+            async with stages_write_lock:
+                stages_changed.clear()
+                try:
+                    await asyncio.to_thread(update_job, job_id, stages_json=json.dumps(stages), heartbeat_at=time.time())
+                except Exception as e:
+                    logger.error(f"Could not record stages of job {job_id}: {str(e)}")
 
-        viz_folder = "visualizations"
-        if os.path.exists(viz_folder):
-            shutil.rmtree(viz_folder)
-        os.makedirs(viz_folder, exist_ok=True)
+    async def finish_job(**fields):
+        # Waits out an in-progress stage write so it can't overwrite the final stages
+        async with stages_write_lock:
+            stage_writer.cancel()
+        await asyncio.to_thread(update_job, job_id, stages_json=json.dumps(stages), finished_at=time.time(), **fields)
 
-        script_path = "visualizations.py"
-        raw_script = viz_crew.tasks[0].output.raw
-        clean_script = re.sub(r'```python|```$', '', raw_script, flags=re.MULTILINE).strip()
+    heartbeat = asyncio.create_task(keep_job_alive(job_id))
+    stage_writer = asyncio.create_task(write_stages())
+    try:
+        response = await analyze_folder(FolderPathRequest(folder_path=folder_path, clear_cache=clear_cache), record_stage)
+        stages.update({stage: "done" for stage in PIPELINE_STAGES if stages[stage] == "pending"})
+        await finish_job(status="done", result_json=response.json())
+        logger.info(f"Job {job_id} done")
+    except Exception as e:
+        stages.update({stage: "failed" for stage in PIPELINE_STAGES if stages[stage] == "running"})
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        await finish_job(status="failed", error=str(detail))
+        logger.error(f"Job {job_id} failed: {detail}")
+    finally:
+        heartbeat.cancel()
+        stage_writer.cancel()
+        plt.close('all')
 
+async def run_job_worker(worker_index: int):
+    worker = f"{os.getpid()}-{worker_index}"
+    while True:
         try:
-            with shared_state.viz_lock:
-                with open(script_path, "w", encoding="utf-8") as f:
-                    f.write(clean_script)
-                logger.info(f"Visualization script written to {script_path}")
-                logger.debug(f"Visualization script content:\n{clean_script}")
-                runpy.run_path(script_path, init_globals={'metrics': metrics})
-                logger.info("Visualization script executed successfully")
+            claimed = await asyncio.to_thread(claim_next_job, worker)
         except Exception as e:
-            logger.error(f"Visualization script failed: {str(e)}")
-            logger.info("Running fallback visualization")
-            run_fallback_visualization(metrics)
-
-        viz_base64 = []
-        expected_count = 10 + (1 if 'Pass/Fail' in metrics.get('metrics', {}) else 0)
-        min_visualizations = 5
-        if os.path.exists(viz_folder):
-            viz_files = sorted([f for f in os.listdir(viz_folder) if f.endswith('.png')])
-            for img in viz_files:
-                img_path = os.path.join(viz_folder, img)
-                base64_str = get_base64_image(img_path)
-                if base64_str:
-                    viz_base64.append(base64_str)
-            logger.info(f"Generated {len(viz_base64)} visualizations, expected {expected_count}, minimum required {min_visualizations}")
-            if len(viz_base64) < min_visualizations:
-                logger.warning("Insufficient visualizations, running fallback")
-                run_fallback_visualization(metrics)
-                viz_files = sorted([f for f in os.listdir(viz_folder) if f.endswith('.png')])
-                viz_base64 = []
-                for img in viz_files:
-                    img_path = os.path.join(viz_folder, img)
-                    base64_str = get_base64_image(img_path)
-                    if base64_str:
-                        viz_base64.append(base64_str)
-                if len(viz_base64) < min_visualizations:
-                    logger.error(f"Still too few visualizations: {len(viz_base64)}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Failed to generate minimum required visualizations: got {len(viz_base64)}, need at least {min_visualizations}"
-                    )
+            logger.error(f"Job worker {worker} could not claim a job: {str(e)}")
+            claimed = None
+        if claimed is None:
+            # Woken early by POST /jobs; the timeout picks up other processes' jobs
+            job_wakeup.clear()
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job_id, folder_path, clear_cache = claimed
+        logger.info(f"Job worker {worker} running job {job_id} for {folder_path}")
+        await run_job(job_id, folder_path, clear_cache)
+
+def start_job_workers() -> List[asyncio.Task]:
+    logger.info(f"Starting {JOB_WORKERS} job workers")
+    return [asyncio.create_task(run_job_worker(i)) for i in range(JOB_WORKERS)]
+
+async def stop_job_workers(workers: List[asyncio.Task]):
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
 
-        score, evaluation = evaluate_with_llm_judge(full_source_text, enhanced_report)
-        logger.info(f"Attempt {attempt}: Evaluation score = {score}")
-        
-        if score > 84:
-            logger.info(f"Score {score} exceeds threshold of 84, proceeding with response")
-            return AnalysisResponse(
-                metrics=metrics,
-                visualizations=viz_base64,
-                report=enhanced_report,
-                evaluation={"score": score, "text": evaluation},
-                hyperlinks=all_hyperlinks
-            )
-        else:
-            logger.warning(f"Score {score} <= 80, retrying report generation (attempt {attempt}/{max_attempts})")
-            attempt += 1
-            if attempt > max_attempts:
-                logger.warning(f"Max attempts ({max_attempts}) reached with score {score}, proceeding with final response")
-                return AnalysisResponse(
-                    metrics=metrics,
-                    visualizations=viz_base64,
-                    report=enhanced_report,
-                    evaluation={"score": score, "text": evaluation},
-                    hyperlinks=all_hyperlinks
-                )
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_pdfs(request: FolderPathRequest):
     try:
-        cleanup_old_cache()
-
-        folder_path = convert_windows_path(request.folder_path)
-        folder_path = os.path.normpath(folder_path)
-        folder_path_hash = hash_string(folder_path)
-        pdf_files = get_pdf_files_from_folder(folder_path)
-        pdfs_hash = hash_pdf_contents(pdf_files)
-        logger.info(f"Computed hashes - folder_path_hash: {folder_path_hash}, pdfs_hash: {pdfs_hash}")
-
-        # Skip cache if clear_cache is True
-        if not request.clear_cache:
-            cached_response = get_cached_report(folder_path_hash, pdfs_hash)
-            if cached_response:
-                logger.info(f"Cache hit for folder_path_hash: {folder_path_hash}")
-                return cached_response
-        else:
-            logger.info(f"Cache bypassed due to clear_cache=True for folder_path_hash: {folder_path_hash}")
-
-        logger.info(f"Running full analysis for folder_path_hash: {folder_path_hash}")
-        response = await run_full_analysis(request)
-
-        store_cached_report(folder_path_hash, pdfs_hash, response)
-        return response
+        return await analyze_folder(request)
 
     except Exception as e:
         logger.error(f"Error in /analyze endpoint: {str(e)}")
@@ -1677,6 +3633,54 @@ async def analyze_pdfs(request: FolderPathRequest):
     finally:
         plt.close('all')
 
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/analyze/stream")
+async def analyze_stream(folder_path: str, clear_cache: bool = False):
+    # Server-sent events for one analysis: stage progress, then metrics,
+    # charts, report sections and the evaluation as they are produced, and
+    # finally the full AnalysisResponse as "result" (or "error"). A cached
+    # report goes straight to "result".
+    request = FolderPathRequest(folder_path=folder_path, clear_cache=clear_cache)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def push(event: str, data: Any):
+        # Charts are published from the render thread
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def run():
+        try:
+            response = await analyze_folder(request, lambda stage, state: push("stage", {"stage": stage, "state": state}), push)
+            push("result", json.loads(response.json()))
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Error in /analyze/stream endpoint: {detail}")
+            push("error", {"detail": str(detail)})
+        finally:
+            plt.close('all')
+            push("done", {})
+
+    async def stream():
+        analysis = asyncio.create_task(run())
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_event(event, data)
+                if event == "done":
+                    break
+        finally:
+            # Only this caller's wait is cancelled; a shared analysis keeps
+            # running. Awaiting it lets run_single_flight unsubscribe push.
+            analysis.cancel()
+            await asyncio.gather(analysis, return_exceptions=True)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 #$$$
 # @app.post("/analyze", response_model=AnalysisResponse)
@@ -1731,46 +3735,53 @@ async def update_metrics(request: UpdateMetricsRequest):
         folder_path = convert_windows_path(request.folder_path)
         folder_path = os.path.normpath(folder_path)
         folder_path_hash = hash_string(folder_path)
-        pdf_files = get_pdf_files_from_folder(folder_path)
-        pdfs_hash = hash_pdf_contents(pdf_files)
+        pdfs_hash = await asyncio.to_thread(hash_folder_pdfs, folder_path)
         logger.info(f"Updating metrics for folder_path_hash: {folder_path_hash}, pdfs_hash: {pdfs_hash}")
 
-        # Get existing cached report or run analysis
-        cached_response = get_cached_report(folder_path_hash, pdfs_hash)
+        # Get existing cached report, stale or not, or run analysis; its
+        # charts are only loaded below if the metrics are unchanged
+        cached_response = get_cached_report(folder_path_hash, pdfs_hash, with_charts=False, allow_stale=True)
         if not cached_response:
             logger.info(f"No cached report found, running full analysis")
             folder_path_request = FolderPathRequest(folder_path=folder_path, clear_cache=False)
-            cached_response = await run_full_analysis(folder_path_request)
-
-        # Update metrics and report
+            cached_response = await run_single_flight(folder_path_request, folder_path_hash, pdfs_hash)
+
+        # Update metrics and report. The Metrics Summary is re-rendered from
+        # the submitted metrics unless the user edited that section's text,
+        # in which case their edit is kept as submitted.
+        submitted = split_report_sections(request.report)
+        sections = {section: enhance_report_markdown(body) for section, body in submitted.items()}
+        cached_summary = split_report_sections(cached_response.report).get("Metrics Summary", "")
+        if submitted.get("Metrics Summary", "").strip() == cached_summary.strip():
+            sections["Metrics Summary"] = render_metrics_summary(compute_trends(deepcopy(request.metrics)))
+        else:
+            logger.info("Metrics Summary was edited, keeping the submitted text")
+            sections["Metrics Summary"] = submitted["Metrics Summary"]
         updated_response = AnalysisResponse(
             metrics=request.metrics,
             visualizations=cached_response.visualizations,  # Keep existing visualizations
-            report=enhance_report_markdown(request.report),
+            report=assemble_report(sections),
             evaluation=cached_response.evaluation,
             hyperlinks=cached_response.hyperlinks
         )
 
+        metrics_changed = json.dumps(request.metrics) != json.dumps(cached_response.metrics)
+        if not metrics_changed and not updated_response.visualizations:
+            with_charts = get_cached_report(folder_path_hash, pdfs_hash, allow_stale=True)
+            updated_response.visualizations = with_charts.visualizations if with_charts else []
+
         # Regenerate visualizations if metrics changed significantly
-        if json.dumps(request.metrics) != json.dumps(cached_response.metrics):
+        if metrics_changed or not updated_response.visualizations:
             logger.info("Metrics changed, regenerating visualizations")
-            viz_folder = "visualizations"
-            if os.path.exists(viz_folder):
-                shutil.rmtree(viz_folder)
-            os.makedirs(viz_folder, exist_ok=True)
-            run_fallback_visualization(request.metrics)
-            viz_base64 = []
-            if os.path.exists(viz_folder):
-                viz_files = sorted([f for f in os.listdir(viz_folder) if f.endswith('.png')])
-                for img in viz_files:
-                    img_path = os.path.join(viz_folder, img)
-                    base64_str = get_base64_image(img_path)
-                    if base64_str:
-                        viz_base64.append(base64_str)
-            updated_response.visualizations = viz_base64
+            ctx = PipelineContext(folder_path)
+            try:
+                charts = await asyncio.to_thread(render_charts, request.metrics, ctx.output_dir)
+            finally:
+                ctx.cleanup()
+            updated_response.visualizations = [charts[filename] for filename in sorted(charts)]
 
         # Update cache
-        store_cached_report(folder_path_hash, pdfs_hash, updated_response)
+        store_cached_report(folder_path_hash, pdfs_hash, updated_response, folder_path)
         logger.info(f"Updated cache for folder_path_hash: {folder_path_hash}")
         return updated_response
 
@@ -1780,12 +3791,69 @@ async def update_metrics(request: UpdateMetricsRequest):
     finally:
         plt.close('all')
 
+@app.post("/jobs", status_code=202)
+async def create_job(request: FolderPathRequest):
+    folder_path = os.path.normpath(convert_windows_path(request.folder_path))
+    if not os.path.exists(folder_path):
+        raise HTTPException(status_code=400, detail=f"Folder path does not exist: {folder_path}")
+    job_id, status = enqueue_job(folder_path, request.clear_cache)
+    job_wakeup.set()
+    return {"job_id": job_id, "status": status}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return {
+        "job_id": job["job_id"],
+        "folder_path": job["folder_path"],
+        "status": job["status"],
+        "stages": json.loads(job["stages_json"]),
+        "queue_position": job["queue_position"] if job["status"] == "queued" else None,
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+@app.get("/jobs/{job_id}/result", response_model=AnalysisResponse)
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    if job["status"] == "failed":
+        raise HTTPException(status_code=500, detail=job["error"])
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+    return AnalysisResponse(**json.loads(job["result_json"]))
+
+os.makedirs("visualizations", exist_ok=True)
 app.mount("/visualizations", StaticFiles(directory="visualizations"), name="visualizations")
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/llm_cache/stats")
+async def llm_cache_stats():
+    return get_llm_cache_stats()
+
+@app.get("/report_cache")
+async def report_cache_index(limit: int = 100):
+    return await asyncio.to_thread(list_cached_reports, limit)
+
+@app.get("/prompt_budget")
+async def prompt_budget(folder_path: Union[str, None] = None):
+    # One folder's latest budget, or every recent folder's keyed by folder_path_hash
+    with prompt_budgets_lock:
+        if folder_path is None:
+            return dict(prompt_budgets)
+        budget = prompt_budgets.get(hash_string(os.path.normpath(convert_windows_path(folder_path))))
+    if budget is None:
+        raise HTTPException(status_code=404, detail=f"No prompt budget recorded for {folder_path}")
+    return budget
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8080)